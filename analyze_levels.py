@@ -0,0 +1,321 @@
+import argparse
+import collections
+import concurrent.futures
+import glob
+import json
+import os
+import sys
+import time
+
+# Nothing here draws, keep pygame away from the display and sound, and its greeting out of --json output
+os.environ.setdefault('PLATFORM_HEADLESS', '1')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import main
+
+TILE = main.TILE_SIZE
+WIDTH, HEIGHT = main.Character.char_size
+SOLID_TILES = main.World.SOLID_TILES
+# Water the player swims in, and the deep water that drowns it straight away at the starting health
+WATER_TILES = (2, 3)
+DEEP_WATER = 4
+# Platforms moving along x and along y, and how far they go either way
+PLATFORM_TILES = {7: (1, 0), 8: (0, 1)}
+PLATFORM_SIZE = (TILE, TILE // 2)
+PLATFORM_RANGE = 50
+FLOWER = 6
+DOOR = 10
+FLOWER_SIZE = TILE // 3
+
+# Jumps tried from every standing spot: steer (direction, from tick, until tick), None steers until landing
+JUMPS = [(0, 0, 0)] + [(direction, start, None) for direction in (-1, 1) for start in (0, 10)] + \
+        [(direction, 0, stop) for direction in (-1, 1) for stop in (8, 16)]
+# Longest a jump, fall or walk to the next tile is followed, in ticks
+MAX_TICKS = 400
+
+
+def overlaps(x, y, width, height, left, top, right_width, bottom_height):
+    return x < left + right_width and left < x + width and y < top + bottom_height and top < y + height
+
+
+class LevelGraph:
+    # Where the player can get to on foot, by jumping and by swimming, on a grid of standing spots and water tiles
+    # Enemies are left out, and moving platforms are ledges at the middle and both ends of their path
+    def __init__(self, level, deep_water_kills=True):
+        self.level = level
+        self.columns = level.width
+        self.rows = level.height
+        self.deep_water_kills = deep_water_kills
+        self.water = set(WATER_TILES) if deep_water_kills else set(WATER_TILES) | {DEEP_WATER}
+        # (column, row) -> tile code, empty tiles left out
+        self.grid = {(index % level.width, index // level.width): tile
+                     for index, tile in enumerate(level.tiles) if tile != -1}
+        self.solid = {cell for cell, tile in self.grid.items() if tile in SOLID_TILES}
+        # Tiles that do something when touched
+        self.special = {cell: tile for cell, tile in self.grid.items()
+                        if tile in (FLOWER, DOOR, DEEP_WATER) or tile in self.water}
+        # (x, y, width, height) of every platform position, by the tiles they cover
+        self.platform_cells = collections.defaultdict(list)
+        # Platform position -> every position of that platform, standing on one rides to the others
+        self.rides = {}
+        self.flowers = {}
+        self.doors = set()
+        # Moves already followed, many standing spots jump from the same place
+        self.moved = {}
+        for (column, row), tile in self.grid.items():
+            if tile in PLATFORM_TILES:
+                move_x, move_y = PLATFORM_TILES[tile]
+                rects = [(column * TILE + step * move_x * PLATFORM_RANGE,
+                          row * TILE + step * move_y * PLATFORM_RANGE) + PLATFORM_SIZE for step in (-1, 0, 1)]
+                for rect in rects:
+                    self.rides[rect] = rects
+                    for cell in self.cells(*rect):
+                        self.platform_cells[cell].append(rect)
+            elif tile == FLOWER:
+                x = column * TILE + TILE // 2 - FLOWER_SIZE // 2
+                y = row * TILE + TILE - 8 - FLOWER_SIZE // 2
+                self.flowers[(column, row)] = (x, y, FLOWER_SIZE, FLOWER_SIZE)
+            elif tile == DOOR:
+                self.doors.add((column, row))
+
+    def tile(self, column, row):
+        # Tile code, the sides of the level are walls and above and below it is open
+        if not 0 <= column < self.columns:
+            return 0
+        return self.grid.get((column, row), -1)
+
+    def cells(self, x, y, width, height):
+        return [(column, row) for row in range(y // TILE, (y + height - 1) // TILE + 1)
+                for column in range(x // TILE, (x + width - 1) // TILE + 1)]
+
+    def step(self, x, y, vel_y, delta_x):
+        # One tick of Player.controls against tiles and platforms, returns x, y, vel_y and whether it stands
+        vel_y = min(vel_y + main.Player.GRAVITY, main.Player.MAX_FALL_SPEED)
+        delta_y = vel_y
+        standing = False
+        reach = main.Player.COLLISION_RANGE
+        # Only what the player would overlap changes anything, the game looks a little further around it
+        swept = self.cells(min(x, x + delta_x), min(y, y + delta_y), WIDTH + abs(delta_x), HEIGHT + abs(delta_y))
+        for column, row in swept:
+            if (column, row) not in self.solid and 0 <= column < self.columns:
+                continue
+            left, top = column * TILE, row * TILE
+            if overlaps(x + delta_x, y, WIDTH, HEIGHT, left, top, TILE, TILE):
+                delta_x = 0
+            if overlaps(x, y + delta_y, WIDTH, HEIGHT, left, top, TILE, TILE):
+                if vel_y < 0:
+                    delta_y = top + TILE - y
+                    vel_y = 0
+                else:
+                    delta_y = top - (y + HEIGHT)
+                    vel_y = 0
+                    standing = True
+        seen = set()
+        for cell in swept:
+            for rect in self.platform_cells.get(cell, ()):
+                if rect in seen:
+                    continue
+                seen.add(rect)
+                # Only one of the positions is really there at a time, so platforms only catch the player from above
+                left, top, width, height = rect
+                if vel_y >= 0 and overlaps(x, y + delta_y, WIDTH, HEIGHT, left, top, width, height):
+                    if abs(y + HEIGHT + delta_y - top) < reach:
+                        y = top - 1 - HEIGHT
+                        delta_y = 0
+                        standing = True
+        return x + delta_x, y + delta_y, vel_y, standing
+
+    def touch(self, x, y, touched):
+        # Remember flowers and doors under the player, returns the water tile it fell in or None
+        water = None
+        deep = False
+        for cell in self.cells(x, y, WIDTH, HEIGHT):
+            tile = self.special.get(cell)
+            if tile is None:
+                continue
+            if tile == FLOWER:
+                if overlaps(x, y, WIDTH, HEIGHT, *self.flowers[cell]):
+                    touched.add(cell)
+            elif tile == DOOR:
+                touched.add(cell)
+            elif tile in self.water:
+                water = water or cell
+            else:
+                deep = True
+        # Swimming into deep water drowns the player
+        if water is not None and deep and self.deep_water_kills:
+            return 'drowned'
+        return water
+
+    def follow(self, x, y, vel_y, steer, touched, walk=False):
+        # Where one move ends up: ('stand', x, y), ('water', column, row) or None when the player dies
+        key = (x, y, vel_y, steer, walk)
+        if key not in self.moved:
+            reached = set()
+            self.moved[key] = self.trace(x, y, vel_y, steer, reached, walk), reached
+        move, reached = self.moved[key]
+        touched.update(reached)
+        return move
+
+    def trace(self, x, y, vel_y, steer, touched, walk):
+        # Run the move tick by tick until the player stands again
+        direction, start, stop = steer
+        column = (x + WIDTH // 2) // TILE
+        for tick in range(MAX_TICKS):
+            delta_x = direction * main.Player.WALKING_SPEED if start <= tick and (stop is None or tick < stop) else 0
+            last_x = x
+            x, y, vel_y, standing = self.step(x, y, vel_y, delta_x)
+            if y > self.rows * TILE:
+                return None
+            water = self.touch(x, y, touched)
+            if water == 'drowned':
+                return None
+            if water is not None:
+                return ('water',) + water
+            # Walks go on until the next tile or a wall
+            if standing and (not walk or x == last_x or (x + WIDTH // 2) // TILE != column):
+                return 'stand', x, y
+        return None
+
+    def spot(self, x, y):
+        # Standing spots are told apart by the tile under the middle of the player
+        return (x + WIDTH // 2) // TILE, y
+
+    def supported(self, x, y):
+        # Standing still at (x, y) without being inside a wall
+        if any(self.tile(*cell) in SOLID_TILES for cell in self.cells(x, y, WIDTH, HEIGHT)):
+            return False
+        # Platforms let the player sink a pixel before catching it again
+        start_y, vel_y = y, 0
+        for _ in range(3):
+            x, y, vel_y, standing = self.step(x, y, vel_y, 0)
+            if standing and y == start_y:
+                return True
+        return False
+
+    def moves(self, x, y, touched):
+        # Everywhere one walk or jump from (x, y) ends up
+        column = (x + WIDTH // 2) // TILE
+        left = column * TILE
+        starts = [x]
+        # Up against either side of the tile, to jump past overhangs, and hanging off either edge of a ledge
+        for start_x in (left, left + TILE - WIDTH, left - WIDTH + 1, left + TILE - 1):
+            if start_x not in starts and self.supported(start_x, y):
+                starts.append(start_x)
+        for direction in (-1, 1):
+            yield self.follow(x, y, 0, (direction, 0, None), touched, walk=True)
+        # Stay on the platform underneath while it moves
+        for cell in self.cells(x, y + HEIGHT + 1, WIDTH, 1):
+            for rect in self.platform_cells.get(cell, ()):
+                if rect[1] == y + HEIGHT + 1 and overlaps(x, y, WIDTH, HEIGHT + 2, *rect):
+                    for other in self.rides[rect]:
+                        if self.supported(x + other[0] - rect[0], y + other[1] - rect[1]):
+                            yield 'stand', x + other[0] - rect[0], y + other[1] - rect[1]
+        for start_x in starts:
+            for steer in JUMPS:
+                yield self.follow(start_x, y, main.Player.JUMP_SPEED, steer, touched)
+
+    def swims(self, column, row, touched):
+        # Neighbouring water, and wherever swimming out of the sides or sinking out of the bottom leads
+        for next_column, next_row in ((column - 1, row), (column + 1, row), (column, row - 1), (column, row + 1)):
+            tile = self.tile(next_column, next_row)
+            if tile in self.water:
+                yield 'water', next_column, next_row
+            elif next_row >= row and tile not in SOLID_TILES and tile != DEEP_WATER:
+                yield self.follow(next_column * TILE + (TILE - WIDTH) // 2, next_row * TILE, 0, (0, 0, 0), touched)
+        # Climbing out at the surface onto a bank
+        if self.tile(column, row - 1) not in self.water:
+            for bank in (column - 1, column + 1):
+                if self.tile(bank, row) in SOLID_TILES and self.tile(bank, row - 1) not in SOLID_TILES:
+                    x = bank * TILE + (TILE - WIDTH) // 2
+                    if self.supported(x, (row - 1) * TILE + TILE - HEIGHT):
+                        yield 'stand', x, (row - 1) * TILE + TILE - HEIGHT
+
+    def search(self, start=main.START_POS):
+        # Breadth first over standing spots and water tiles from where the level starts
+        touched = set()
+        first = self.follow(start[0], start[1], 0, (0, 0, 0), touched)
+        queue = collections.deque([first] if first else [])
+        seen = set()
+        while queue:
+            move = queue.popleft()
+            key = self.spot(move[1], move[2]) if move[0] == 'stand' else move
+            if key in seen:
+                continue
+            seen.add(key)
+            if move[0] == 'water':
+                self.touch(move[1] * TILE + (TILE - WIDTH) // 2, move[2] * TILE, touched)
+                queue.extend(next_move for next_move in self.swims(move[1], move[2], touched) if next_move)
+            else:
+                queue.extend(next_move for next_move in self.moves(move[1], move[2], touched) if next_move)
+        return seen, touched
+
+
+def analyze(level, name='level'):
+    start = time.perf_counter()
+    graph = LevelGraph(level)
+    seen, touched = graph.search()
+    door = bool(graph.doors & touched)
+    # Try again with deep water as plain water, to tell whether it is what stands in the way
+    deep_water = False
+    if not door and DEEP_WATER in graph.grid.values():
+        deep_water = bool(graph.doors & LevelGraph(level, deep_water_kills=False).search()[1])
+    return {
+        'level': name,
+        'door': door,
+        'flowers': len(graph.flowers.keys() & touched),
+        'flower_total': len(graph.flowers),
+        'unreachable_flowers': sorted(graph.flowers.keys() - touched),
+        'blocked_by_deep_water': deep_water,
+        'spots': len(seen),
+        'ms': (time.perf_counter() - start) * 1000,
+    }
+
+
+def analyze_file(path):
+    # Runs in the worker processes
+    try:
+        return analyze(main.Level.load(path), path)
+    except (OSError, main.LevelError) as error:
+        return {'level': path, 'error': str(error)}
+
+
+def analyze_files(paths, workers=None):
+    # Levels are independent, one process per core
+    if workers == 1:
+        return [analyze_file(path) for path in paths]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = max(1, len(paths) // ((workers or os.cpu_count() or 1) * 4))
+        return list(executor.map(analyze_file, paths, chunksize=chunksize))
+
+
+def report(result):
+    if 'error' in result:
+        return f'{result["level"]}: {result["error"]}'
+    door = 'door reachable' if result['door'] else 'DOOR UNREACHABLE'
+    if result['blocked_by_deep_water']:
+        door += ' (deep water is in the way)'
+    line = f'{result["level"]}: {door}, {result["flowers"]}/{result["flower_total"]} flowers'
+    if result['unreachable_flowers']:
+        line += ', missing ' + ' '.join(f'{column},{row}' for column, row in result['unreachable_flowers'])
+    return line
+
+
+def failed(result):
+    return 'error' in result or not result['door'] or bool(result['unreachable_flowers'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that the door and every flower of a level can be reached')
+    parser.add_argument('levels', nargs='*', help='.lvl files, every level in levels/ by default')
+    parser.add_argument('--workers', type=int, default=None, help='processes to use, one per core by default')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per level')
+    args = parser.parse_args()
+    paths = args.levels or sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'levels', '*.lvl')))
+    start = time.perf_counter()
+    results = analyze_files(paths, args.workers)
+    for result in results:
+        print(json.dumps(result) if args.json else report(result))
+    if not args.json:
+        print(f'{len(results)} levels in {time.perf_counter() - start:.2f} s, {sum(map(failed, results))} with problems')
+    sys.exit(1 if any(map(failed, results)) else 0)
@@ -0,0 +1,679 @@
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import pickle
+import random
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import tracemalloc
+
+# Run without a window or audio device
+os.environ.setdefault('PLATFORM_HEADLESS', '1')
+
+import pygame
+
+import main
+
+main.init()
+
+
+def generate_level(columns, rows):
+    # Walled level with a floor and a ledge every few rows
+    data = [[-1] * columns for _ in range(rows)]
+    for column in range(columns):
+        data[0][column] = 0
+        data[rows - 1][column] = 1
+    for row in range(rows):
+        data[row][0] = 0
+        data[row][columns - 1] = 0
+    for row in range(3, rows - 1, 3):
+        for column in range(2, columns - 2):
+            if column % 5 != 0:
+                data[row][column] = 1
+    for row in range(4, rows - 1, 6):
+        data[row][columns // 2] = 7
+    return main.Level.from_rows(data)
+
+
+def generate_enemies(count, codes=(5, 9, 11, 7)):
+    # Walled square packed with worms, flies and platforms, or the given tile codes
+    side = int(count ** 0.5) + 3
+    data = [[-1] * side for _ in range(side)]
+    for index in range(side):
+        data[0][index] = data[side - 1][index] = data[index][0] = data[index][side - 1] = 0
+    cells = [(row, column) for row in range(1, side - 1) for column in range(1, side - 1)]
+    for number, (row, column) in enumerate(cells[:count]):
+        data[row][column] = codes[number % len(codes)]
+    return main.Level.from_rows(data)
+
+
+def stress_level(columns, rows, enemies=0.02, platforms=0.01, water=0.05, flowers=0.02, seed=0):
+    # generate_level with worms, flies, platforms, water and flowers on that share of the open tiles, door bottom right
+    level = generate_level(columns, rows)
+    rng = random.Random(seed)
+    kinds = ((enemies, (5, 9, 11)), (platforms, (7, 8)), (water, (2, 3, 4)), (flowers, (6,)))
+    for index, tile in enumerate(level.tiles):
+        if tile != -1:
+            continue
+        roll = rng.random()
+        for share, codes in kinds:
+            if roll < share:
+                level.tiles[index] = rng.choice(codes)
+                break
+            roll -= share
+    level.tiles[(rows - 2) * columns + columns - 2] = 10
+    return level
+
+
+def load_level(level):
+    return main.Level.load(f'levels/level{level}.lvl')
+
+
+def start_view(world, rect):
+    # Load the chunks a camera following rect would show
+    camera = main.Camera(world.bounds)
+    camera.snap(rect)
+    world.stream(camera.view)
+    return camera
+
+
+def loaded_tiles(world):
+    return [rect for key in world.loaded for rect in world.chunks[key].tiles]
+
+
+def loaded_layers(world):
+    return [layer for key in world.loaded for layer in world.chunks[key].layers]
+
+
+class HeldKeys:
+    # Stand-in for pygame.key.get_pressed() with a fixed set of keys down
+    def __init__(self, *keys):
+        self.keys = set(keys)
+
+    def __getitem__(self, key):
+        return key in self.keys
+
+
+@contextlib.contextmanager
+def counting_transforms():
+    # Count surfaces made by pygame.transform, the asset cache included
+    counter = {'surfaces': 0}
+    originals = {name: getattr(pygame.transform, name) for name in ('scale', 'flip', 'rotate')}
+
+    def counted(transform):
+        def wrapper(*args, **kwargs):
+            counter['surfaces'] += 1
+            return transform(*args, **kwargs)
+        return wrapper
+
+    for name, transform in originals.items():
+        setattr(pygame.transform, name, counted(transform))
+    try:
+        yield counter
+    finally:
+        for name, transform in originals.items():
+            setattr(pygame.transform, name, transform)
+
+
+def collision(sizes=(16, 64, 256, 512), frames=600):
+    # Time spent in player collision per frame as the level grows
+    print(f'{"level size":>12} {"tiles":>8} {"us/frame":>10}')
+    for size in sizes:
+        world = main.World(generate_level(size, size))
+        player = main.Player(100, main.TILE_SIZE * (size - 2))
+        start_view(world, player.rect)
+        elapsed = 0
+        for _ in range(frames):
+            world.platform_group.update()
+            start = time.perf_counter()
+            player.controls(world)
+            elapsed += time.perf_counter() - start
+        print(f'{f"{size}x{size}":>12} {len(loaded_tiles(world)):>8} {elapsed / frames * 1e6:>10.1f}')
+
+
+def tile_layer(frames=600):
+    # Blits and pixel memory of the baked tile layers around the start, against the scaled copy of the
+    # unconverted image every tile of the level used to hold
+    print(f'{"level":>6} {"tiles":>6} {"blits":>6} {"copies KB":>10} {"layer KB":>9} {"us/draw":>8}')
+    window = pygame.Surface((main.WIDTH, main.HEIGHT)).convert()
+    tile = pygame.transform.scale(pygame.image.load(main.DIRT), (main.TILE_SIZE, main.TILE_SIZE))
+    for level in range(1, 11):
+        data = load_level(level)
+        world = main.World(data)
+        start_view(world, pygame.Rect(main.START_POS, (main.TILE_SIZE, main.TILE_SIZE)))
+        tiles = sum(1 for code in data.tiles if code in main.World.SOLID_TILES)
+        layers = loaded_layers(world)
+        tile_bytes = tiles * tile.get_pitch() * tile.get_height()
+        layer_bytes = sum(layer.get_pitch() * layer.get_height() for layer, rect in layers)
+        start = time.perf_counter()
+        for _ in range(frames):
+            world.draw(window)
+        elapsed = time.perf_counter() - start
+        print(f'{level:>6} {tiles:>6} {len(layers):>6} {tile_bytes // 1024:>10} '
+              f'{layer_bytes // 1024:>9} {elapsed / frames * 1e6:>8.1f}')
+
+
+def level_load(rounds=5, frames=600):
+    # World construction time over all levels and sprite draw time per frame
+    window = pygame.Surface((main.WIDTH, main.HEIGHT)).convert()
+    levels = [load_level(level) for level in range(1, 11)]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        worlds = [main.build_world(number, 0, data) for number, data in enumerate(levels, 1)]
+    elapsed = time.perf_counter() - start
+    print(f'World construction: {elapsed / rounds / len(levels) * 1e3:.2f} ms/level')
+
+    groups = ('water_group', 'under_water_group', 'worm_group', 'fly_group', 'flower_group', 'platform_group', 'door_group')
+    start = time.perf_counter()
+    for _ in range(frames):
+        for world in worlds:
+            for group in groups:
+                getattr(world, group).draw(window)
+    elapsed = time.perf_counter() - start
+    print(f'Sprite draw: {elapsed / frames / len(worlds) * 1e6:.1f} us/frame')
+
+
+def level_switch(rounds=20):
+    # Time the door swap takes with and without the next level prefetched
+    loader = main.LevelLoader()
+    for prefetched in (False, True):
+        elapsed = 0
+        for seed in range(rounds):
+            for level in range(2, 11):
+                if prefetched:
+                    loader.prefetch(level, seed)
+                    loader.pending[1].result()
+                start = time.perf_counter()
+                loader.world(level, seed)
+                elapsed += time.perf_counter() - start
+        print(f'Level switch {"prefetched" if prefetched else "synchronous"}: {elapsed / rounds / 9 * 1e3:.3f} ms')
+
+
+def level_parse(size=1024, rounds=5):
+    # Reading a large level from the old pickle format against the .lvl format
+    level = generate_level(size, size)
+    with tempfile.TemporaryDirectory() as directory:
+        pickle_path = os.path.join(directory, 'level')
+        level_path = os.path.join(directory, 'level.lvl')
+        with open(pickle_path, 'wb') as pickle_out:
+            pickle.dump(level.rows(), pickle_out)
+        level.save(level_path)
+        for name, load in (('pickle', main.Level.from_pickle), ('lvl', main.Level.load)):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                load(pickle_path if name == 'pickle' else level_path)
+            elapsed = time.perf_counter() - start
+            print(f'Parse {size}x{size} {name}: {elapsed / rounds * 1e3:.1f} ms')
+
+
+def swimming(frames=600):
+    # New surfaces per frame while swimming in every direction
+    data = generate_level(16, 16)
+    for row in range(5, 15):
+        for column in range(1, 15):
+            data.tiles[row * data.width + column] = 2
+    world = main.World(data)
+    player = main.Player(7 * main.TILE_SIZE, 9 * main.TILE_SIZE)
+    start_view(world, player.rect)
+    get_pressed = pygame.key.get_pressed
+    allocations = main.ASSETS.allocations
+    with counting_transforms() as counter:
+        for direction in (pygame.K_UP, pygame.K_RIGHT, pygame.K_LEFT):
+            pygame.key.get_pressed = lambda: HeldKeys(direction)
+            for _ in range(frames // 3):
+                player.rect.y += 1
+                player.swim(world)
+    pygame.key.get_pressed = get_pressed
+    print(f'Swimming: {counter["surfaces"] / frames:.2f} new surfaces/frame, '
+          f'{main.ASSETS.allocations - allocations} cache allocations')
+
+
+def enemies(counts=(100, 1000, 5000), ticks=300):
+    # Worm, fly and platform update and draw time per tick, one sprite at a time against NumPy arrays
+    print(f'{"entities":>9} {"store":>6} {"update us":>10} {"draw us":>8}')
+    window = pygame.Surface((main.WIDTH, main.HEIGHT)).convert()
+    renderer = main.Renderer(dirty=False)
+    store = main.ENTITY_STORE
+    for count in counts:
+        level = generate_enemies(count)
+        for main.ENTITY_STORE in ((False, True) if main.numpy is not None else (False,)):
+            world = main.World(level)
+            world.stream(pygame.Rect(0, 0, world.width, world.height))
+            groups = (world.worm_group, world.fly_group, world.platform_group)
+            update = draw = 0
+            for _ in range(ticks):
+                start = time.perf_counter()
+                world.clock.tick()
+                for group in groups:
+                    group.update()
+                update += time.perf_counter() - start
+                start = time.perf_counter()
+                for group in groups:
+                    renderer.draw_group(window, group, 0.5)
+                draw += time.perf_counter() - start
+            print(f'{count:>9} {"numpy" if main.ENTITY_STORE else "off":>6} {update / ticks * 1e6:>10.1f} '
+                  f'{draw / ticks * 1e6:>8.1f}')
+    main.ENTITY_STORE = store
+
+
+def broadphase(counts=(100, 1000, 5000), ticks=300):
+    # Player checks against water, enemies, flowers and doors: a scan per group against one grid query
+    print(f'{"entities":>9} {"scans us":>9} {"grid us":>8}')
+    for count in counts:
+        world = main.World(generate_enemies(count, (2, 4, 5, 6, 9, 10)))
+        world.stream(pygame.Rect(0, 0, world.width, world.height))
+        player = main.Player(world.width // 2, world.height // 2)
+        tiles = (list(world.water_group), list(world.water_group), list(world.under_water_group),
+                 list(world.door_group))
+        sprites = (world.worm_group, world.fly_group, world.flower_group)
+        start = time.perf_counter()
+        for _ in range(ticks):
+            for rects in tiles:
+                player.touching(rects)
+            for group in sprites:
+                player.collided(group)
+        scans = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(ticks):
+            contacts = world.contacts(player.rect.inflate(main.TILE_SIZE, main.TILE_SIZE))
+            for kind in ('water', 'water', 'under_water', 'door'):
+                player.touching(contacts[kind])
+            for kind in ('worm', 'fly', 'flower'):
+                player.collided(contacts[kind])
+        grid = time.perf_counter() - start
+        print(f'{count:>9} {scans / ticks * 1e6:>9.1f} {grid / ticks * 1e6:>8.1f}')
+
+
+MEMORY_SCRIPT = '''
+import gc
+import json
+import sys
+import tracemalloc
+# main.py of the tree being measured
+sys.path.insert(0, sys.argv[1])
+import main
+import pygame
+if hasattr(main, 'init'):
+    main.init()
+count, levels = json.load(sys.stdin)
+
+
+def loaded_bytes(rows):
+    level = main.Level.from_rows(rows)
+    gc.collect()
+    tracemalloc.start()
+    world = main.World(level)
+    world.stream(pygame.Rect(0, 0, world.width, world.height))
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size
+
+
+empty = loaded_bytes(levels[0])
+print(json.dumps([(loaded_bytes(rows) - empty) / count for rows in levels[1:]]))
+'''
+
+
+def memory(count=5000, before=None):
+    # Python heap bytes per entity once a level full of one kind is loaded, level tiles left out.
+    # Every tree is measured in a fresh interpreter, before is a git revision measured next to this one
+    kinds = (('water', 2), ('deep water', 3), ('under water', 4), ('worm', 5), ('flower', 6), ('platform', 7),
+             ('fly', 9), ('door', 10))
+    levels = [generate_enemies(count, (code,)).rows() for code in [-1] + [code for name, code in kinds]]
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    def measure(tree):
+        output = subprocess.run([sys.executable, '-c', MEMORY_SCRIPT, tree], cwd=tree,
+                                input=json.dumps([count, levels]), check=True, capture_output=True, text=True).stdout
+        # Last line, pygame prints a greeting first
+        return json.loads(output.splitlines()[-1])
+
+    after = measure(directory)
+    old = None
+    if before is not None:
+        # The whole tree at before, with its own images and caches, so nothing in the checkout is touched
+        with tempfile.TemporaryDirectory() as old_directory:
+            try:
+                archive = subprocess.run(['git', 'archive', '--format=tar', before], cwd=directory, check=True,
+                                         capture_output=True).stdout
+            except (OSError, subprocess.CalledProcessError):
+                print(f'Memory: no git revision {before}, only this tree is measured')
+            else:
+                with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+                    tar.extractall(old_directory)
+                old = measure(old_directory)
+    if old is None:
+        print(f'{"kind":>11} {"bytes/entity":>13}')
+        for (name, code), size in zip(kinds, after):
+            print(f'{name:>11} {size:>13.0f}')
+        return
+    print(f'{"kind":>11} {before[:12]:>12} {"this tree":>10}')
+    for (name, code), old_size, size in zip(kinds, old, after):
+        print(f'{name:>11} {old_size:>12.0f} {size:>10.0f}')
+
+
+def restarts(rounds=1000, frames=3, every=200):
+    # Heap size while restarting the game over and over, should stay flat
+    print(f'{"restarts":>9} {"heap KB":>8}')
+    session = main.Session(state=main.PLAYING)
+    tracemalloc.start()
+    for restart in range(1, rounds + 1):
+        for _ in range(frames):
+            session.frame()
+        session.start_game()
+        if restart % every == 0:
+            gc.collect()
+            print(f'{restart:>9} {tracemalloc.get_traced_memory()[0] // 1024:>8}')
+    tracemalloc.stop()
+
+
+STARTUP_SCRIPT = '''
+import time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+main.init()
+main.Session()
+print(imported - start, time.perf_counter() - start)
+'''
+
+
+def startup(rounds=10):
+    # Cold start in a fresh interpreter, best of a few runs: importing main, and up to the first menu frame
+    directory = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for _ in range(rounds):
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], cwd=directory, check=True,
+                                capture_output=True, text=True).stdout
+        # Last line, pygame prints a greeting first
+        runs.append([float(value) for value in output.splitlines()[-1].split()])
+    print(f'Startup: import {min(run[0] for run in runs) * 1e3:.0f} ms, '
+          f'first menu frame {min(run[1] for run in runs) * 1e3:.0f} ms')
+
+
+def streaming(sizes=(16, 64, 256, 1024), frames=600):
+    # Frame cost and loaded chunks while running right along the floor of ever larger levels
+    print(f'{"level size":>12} {"chunks":>7} {"loaded":>7} {"layer KB":>9} {"us/frame":>10}')
+    keys = HeldKeys(pygame.K_RIGHT)
+    window = pygame.Surface((main.WIDTH, main.HEIGHT)).convert()
+    for size in sizes:
+        world = main.World(generate_level(size, size))
+        player = main.Player(100, main.TILE_SIZE * (size - 2))
+        camera = start_view(world, player.rect)
+        most_loaded = layer_bytes = 0
+        start = time.perf_counter()
+        for _ in range(frames):
+            world.worm_group.update()
+            world.fly_group.update()
+            world.platform_group.update()
+            player.controls(world, keys)
+            camera.follow(player.rect)
+            world.stream(camera.view)
+            world.draw(window, camera.offset)
+            if len(world.loaded) > most_loaded:
+                most_loaded = len(world.loaded)
+                layer_bytes = sum(layer.get_pitch() * layer.get_height() for layer, rect in loaded_layers(world))
+        elapsed = time.perf_counter() - start
+        print(f'{f"{size}x{size}":>12} {world.chunk_columns * world.chunk_rows:>7} {most_loaded:>7} '
+              f'{layer_bytes // 1024:>9} {elapsed / frames * 1e6:>10.1f}')
+
+
+def sprite_images(rounds=20):
+    # Cold load of every sprite image at the size it is drawn, scaled from its file against cut from the atlas,
+    # best of a few rounds
+    if main.ATLAS.read_index() is None:
+        main.ATLAS.build()
+    loads = {'files': 0}
+    load = pygame.image.load
+
+    def counted(function):
+        def wrapper(*args, **kwargs):
+            loads['files'] += 1
+            return function(*args, **kwargs)
+        return wrapper
+
+    print(f'{"images":>8} {"files":>6} {"pixel buffers":>14} {"ms":>8}')
+    for name, atlas in (('files', None), ('atlas', main.ATLAS)):
+        best = None
+        # Images are read with pygame, the atlas with open()
+        pygame.image.load = counted(load)
+        main.open = counted(open)
+        try:
+            for _ in range(rounds):
+                loads['files'] = 0
+                if atlas is not None:
+                    atlas = main.Atlas(atlas.path, atlas.keys)
+                assets = main.AssetCache(atlas)
+                start = time.perf_counter()
+                images = [assets.get(*key) for key in main.ATLAS.keys]
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+        finally:
+            pygame.image.load = load
+            del main.open
+        buffers = len({id(image.get_parent() or image) for image in images})
+        print(f'{name:>8} {loads["files"]:>6} {buffers:>14} {best * 1e3:>8.1f}')
+
+
+def level_analysis(copies=10):
+    # Reachability checks of a batch of levels, the bundled ones a few times over, in one process and in a pool
+    import analyze_levels
+    directory = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as folder:
+        paths = []
+        for number in range(1, 11):
+            level = main.Level.load(os.path.join(directory, 'levels', f'level{number}.lvl'))
+            for copy in range(copies):
+                paths.append(os.path.join(folder, f'level{number}-{copy}.lvl'))
+                level.save(paths[-1])
+        print(f'{"workers":>8} {"levels":>7} {"s":>7} {"levels/s":>9}')
+        for workers in (1, None):
+            start = time.perf_counter()
+            analyze_levels.analyze_files(paths, workers)
+            elapsed = time.perf_counter() - start
+            print(f'{workers or os.cpu_count():>8} {len(paths):>7} {elapsed:>7.2f} {len(paths) / elapsed:>9.1f}')
+
+
+def rollout_throughput(level=9, runs=64, ticks=1200):
+    # Simulated ticks per second of random players, one game at a time, batched, and batched across processes
+    import rollouts
+    print(f'{"rollouts":>22} {"ticks":>8} {"ticks/s":>9}')
+    for name, batched in (('one game at a time', False), ('batched', True)):
+        start = time.perf_counter()
+        heatmaps = rollouts.RolloutBatch(level, runs, max_ticks=ticks, seed=1, batched=batched).run()
+        elapsed = time.perf_counter() - start
+        print(f'{name:>22} {heatmaps.ticks:>8} {heatmaps.ticks / elapsed:>9.0f}')
+    start = time.perf_counter()
+    heatmaps = rollouts.rollouts(level, runs * 4, max_ticks=ticks, seed=1)
+    elapsed = time.perf_counter() - start
+    print(f'{f"{os.cpu_count()} processes":>22} {heatmaps.ticks:>8} {heatmaps.ticks / elapsed:>9.0f}')
+
+
+# Size of the stress level the suite runs on, and how many times each scenario is timed, the best run counts
+SUITE_LEVEL = (256, 64)
+SUITE_REPEATS = 5
+
+
+def best_of(function, repeats=SUITE_REPEATS):
+    # Fastest of a few runs, in seconds, the slower ones are other things the machine was doing
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def suite_level_load(level):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'stress.lvl')
+        level.save(path)
+        return best_of(lambda: main.Level.load(path)) * 1e3
+
+
+def suite_world_build(level):
+    return best_of(lambda: main.build_world(1, 0, level)) * 1e3
+
+
+def suite_render_frame(level, dirty, frames=200):
+    # Session.refresh_window on a game of the stress level, a tick of enemies between frames.
+    # No prefetch, building the next level on a thread would take time from the frames
+    session = main.Session()
+    session.renderer = main.Renderer(dirty)
+    session.state = main.PLAYING
+    game = session.game = main.Game(prefetch=False)
+    game.world = main.build_world(1, 0, level)
+    game.player = main.Player(main.TILE_SIZE * 2, main.TILE_SIZE * (level.height - 2))
+    game.start_camera()
+
+    def frames_drawn():
+        for _ in range(frames):
+            game.update_sprites()
+            session.refresh_window(0.5)
+
+    return best_of(frames_drawn) / frames * 1e6
+
+
+def suite_collision(level, ticks=600):
+    world = main.World(level)
+    player = main.Player(main.TILE_SIZE * 2, main.TILE_SIZE * (level.height - 2))
+    start_view(world, player.rect)
+    inputs = main.random_inputs(random.Random(0))
+    keys = [next(inputs) for _ in range(ticks)]
+    start = player.rect.copy()
+
+    def controls():
+        player.rect = start.copy()
+        player.vel_y = 0
+        for key in keys:
+            player.controls(world, key)
+
+    return best_of(controls) / ticks * 1e6
+
+
+def suite_sprite_update(level, ticks=300):
+    # Every chunk loaded, so all of the level's enemies and platforms move
+    world = main.World(level)
+    world.stream(pygame.Rect(0, 0, world.width, world.height))
+    groups = (world.worm_group, world.fly_group, world.platform_group)
+
+    def update():
+        for _ in range(ticks):
+            for group in groups:
+                group.update()
+
+    return best_of(update) / ticks * 1e6
+
+
+def suite():
+    # Scenario name -> (time, unit), lower is better
+    level = stress_level(*SUITE_LEVEL)
+    return {
+        'level_load': (suite_level_load(level), 'ms'),
+        'world_build': (suite_world_build(level), 'ms'),
+        'render_frame_full': (suite_render_frame(level, False), 'us'),
+        'render_frame_dirty': (suite_render_frame(level, True), 'us'),
+        'collision': (suite_collision(level), 'us'),
+        'sprite_update': (suite_sprite_update(level), 'us'),
+    }
+
+
+def run_suite(path=None):
+    results = suite()
+    print(f'{"scenario":>20} {"time":>10}')
+    for name, (value, unit) in results.items():
+        print(f'{name:>20} {value:>7.2f} {unit}')
+    if path is not None:
+        with open(path, 'w') as file:
+            json.dump({
+                'level': list(SUITE_LEVEL),
+                'numpy': main.numpy is not None,
+                'python': sys.version.split()[0],
+                'pygame': pygame.version.ver,
+                'results': {name: {'value': value, 'unit': unit} for name, (value, unit) in results.items()},
+            }, file, indent=2)
+    return results
+
+
+def compare(old_path, new_path, threshold=0.1):
+    # Flag every scenario that got slower by more than threshold, returns True when none did
+    with open(old_path) as file:
+        old = json.load(file)['results']
+    with open(new_path) as file:
+        new = json.load(file)['results']
+    regressions = 0
+    print(f'{"scenario":>20} {"old":>10} {"new":>10} {"change":>8}')
+    for name in sorted(old.keys() | new.keys()):
+        if name not in old or name not in new:
+            print(f'{name:>20} {"only in " + ("new" if name in new else "old"):>30}')
+            continue
+        before, after = old[name]['value'], new[name]['value']
+        change = after / before - 1 if before else 0.0
+        flag = ''
+        if change > threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        elif change < -threshold:
+            flag = 'faster'
+        print(f'{name:>20} {before:>7.2f} {old[name]["unit"]:<2} {after:>7.2f} {new[name]["unit"]:<2} {change:>+8.1%} {flag}')
+    print(f'{regressions} regressions over {threshold:.0%}')
+    return regressions == 0
+
+
+def backends(frames=200):
+    # The stress level drawn onto the display surface and with textures through an SDL renderer, microseconds a frame
+    print(f'{"backend":>20} {"us/frame":>9} {"uploads":>8}')
+    level = stress_level(*SUITE_LEVEL)
+    window = main.WIN
+    print(f'{"surface, dirty":>20} {suite_render_frame(level, True, frames):>9.0f} {"-":>8}')
+    print(f'{"surface, full":>20} {suite_render_frame(level, False, frames):>9.0f} {"-":>8}')
+    if main.sdl2_video is None:
+        print(f'{"textures":>20} {"no pygame._sdl2":>18}')
+        return
+    for accelerated, name in ((True, 'textures, gpu'), (False, 'textures, software')):
+        main.WIN = main.TextureWindow('Platform', (main.WIDTH, main.HEIGHT), accelerated)
+        if main.WIN.accelerated != accelerated:
+            print(f'{name:>20} {"no gpu":>9}')
+            continue
+        print(f'{name:>20} {suite_render_frame(level, False, frames):>9.0f} {main.WIN.uploads:>8}')
+    # Back to the display surface the other benchmarks draw on
+    main.WIN = window if window is pygame.display.get_surface() else pygame.display.set_mode((main.WIDTH, main.HEIGHT))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Platform game benchmarks')
+    parser.add_argument('--suite', action='store_true', help='run only the timed scenarios checked for regressions')
+    parser.add_argument('--json', metavar='FILE', help='run the suite and save its results to FILE')
+    parser.add_argument('--compare', metavar=('OLD', 'NEW'), nargs=2, help='compare two saved suite runs')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown counted as a regression, 0.1 is 10%%')
+    parser.add_argument('--before', metavar='REV', default='HEAD',
+                        help='git revision the memory scenario measures next to this tree, HEAD by default')
+    args = parser.parse_args()
+    if args.compare:
+        sys.exit(0 if compare(*args.compare, args.threshold) else 1)
+    if args.suite or args.json:
+        run_suite(args.json)
+        sys.exit(0)
+    collision()
+    tile_layer()
+    level_load()
+    level_parse()
+    level_switch()
+    swimming()
+    enemies()
+    broadphase()
+    memory(before=args.before)
+    restarts()
+    startup()
+    streaming()
+    sprite_images()
+    level_analysis()
+    rollout_throughput()
+    backends()
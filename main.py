@@ -1,71 +1,507 @@
+import argparse
+import array
+import collections
+import concurrent.futures
+import csv
+import json
+import mmap
+import os
 import pygame
 import random
 import pickle
+import struct
 import sys
-
-pygame.mixer.pre_init(44100, -16, 2, 512)
-pygame.mixer.init()
-pygame.font.init()
-
-# Window
+import threading
+import time
+import weakref
+import zlib
+
+# NumPy is optional, enemies and platforms fall back to updating one sprite at a time
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# SDL renderer and textures are optional too, without them everything is blitted onto the display surface
+try:
+    from pygame._sdl2 import video as sdl2_video
+except ImportError:
+    sdl2_video = None
+
+# Headless runs simulate the game without a window or audio device
+HEADLESS = os.environ.get('PLATFORM_HEADLESS', '') not in ('', '0') or (__name__ == '__main__' and '--headless' in sys.argv)
+
+# Window, opened by init()
 WIDTH = 800
 HEIGHT = 800
-WIN = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption('Platform')
+WIN = None
+# Frame cap for drawing, 0 draws as fast as the display allows (python main.py --uncapped)
 FPS = 60
-
-# Fonts
-RESTART_FONT = pygame.font.SysFont('tahoma', 70)
-SCORE_FONT = pygame.font.SysFont('tahoma', 20)
-FINISH_FONT = pygame.font.SysFont('tahoma', 30)
+# Game logic always runs at this many ticks per second
+TICK_RATE = 60
+# Most ticks to run before drawing a frame when the game falls behind
+MAX_TICKS_PER_FRAME = 5
+# Redraw only the parts of the screen that changed, False redraws everything every frame
+DIRTY_RECTS = True
+# Draw with textures through an SDL renderer, on the GPU when there is one, instead of onto the display surface
+TEXTURES = False
+# Move worms, flies and platforms a whole group at a time in NumPy arrays, needs NumPy.
+# Pays off from about a hundred of them loaded, the levels that come with the game have a few dozen at most
+ENTITY_STORE = False
+
+# Fonts, as (name, size), made on first use
+RESTART_FONT = ('tahoma', 70)
+SCORE_FONT = ('tahoma', 20)
+FINISH_FONT = ('tahoma', 30)
+PROFILER_FONT = ('tahoma', 14)
 
 # Colors
 WHITE = (255, 255, 255)
 ORANGE = (255, 102, 0)
 BLACK = (0, 0, 0)
 
-# Images
-SUN = pygame.image.load('images/sun.png')
-BG = pygame.image.load('images/backgroundForest.png')
-DIRT = pygame.image.load('images/snow0.png')
-GRASS = pygame.image.load('images/snow1.png')
-PLATFORM = pygame.image.load('images/snowhalf.png')
+
+def init(headless=None, textures=None):
+    # Open the window and start sound, anything that draws or loads images needs this first
+    global WIN
+    if WIN is not None:
+        return WIN
+    if headless is None:
+        headless = HEADLESS
+    if textures is None:
+        textures = TEXTURES
+    if headless:
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    else:
+        pygame.mixer.pre_init(MIXER_FREQUENCY, -16, 2, MIXER_BUFFER)
+        try:
+            pygame.mixer.init()
+        except pygame.error:
+            # No audio device, play on without sound
+            pass
+        AUDIO.start()
+    if textures and not headless and sdl2_video is not None:
+        WIN = TextureWindow('Platform', (WIDTH, HEIGHT))
+    else:
+        WIN = pygame.display.set_mode((WIDTH, HEIGHT))
+        pygame.display.set_caption('Platform')
+    return WIN
+
+
+def present(rects=None):
+    # Show the frame, only the given screen areas of it when blitting onto the display surface
+    if isinstance(WIN, TextureWindow):
+        WIN.present()
+    elif rects is None:
+        pygame.display.update()
+    else:
+        pygame.display.update(rects)
+
+
+def load_image(path):
+    # Convert to the display pixel format once, so blits don't convert every frame
+    image = pygame.image.load(path)
+    if image.get_flags() & pygame.SRCALPHA:
+        return image.convert_alpha()
+    return image.convert()
+
+
+# Sprite images are packed into sheets at most this many pixels on a side
+ATLAS_SIZE = 2048
+# Empty pixels between packed images, keeps filtering from bleeding into neighbours
+ATLAS_PADDING = 1
+
+
+class Atlas:
+    # Packs the images the game draws, each at the size and way round it is drawn, into a few sheets.
+    # Sheets are saved as zlib compressed RGBA pixels in <path>0.rgba.z, <path>1.rgba.z, ...
+    # with the size of each sheet and where every image is on it in <path>.json
+    def __init__(self, path, keys, size=ATLAS_SIZE):
+        self.path = path
+        # (image path, size, flip, rotation) of every image, as AssetCache.get() is asked for it
+        self.keys = [tuple(key) for key in keys]
+        self.size = size
+        # Key -> subsurface of its sheet, filled the first time a frame is asked for
+        self.frames = None
+        self.sheets = []
+
+    def sheet_path(self, n):
+        return f'{self.path}{n}.rgba.z'
+
+    def read_index(self):
+        # The saved frame index, None when it is missing or older than any of the images
+        try:
+            with open(self.path + '.json') as file:
+                index = json.load(file)
+            built = os.path.getmtime(self.path + '.json')
+            if index['keys'] != json.loads(json.dumps(self.keys)) or len(index['frames']) != len(self.keys):
+                return None
+            if any(os.path.getmtime(key[0]) > built for key in self.keys):
+                return None
+            if not all(os.path.exists(self.sheet_path(n)) for n in range(len(index['sheets']))):
+                return None
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return index
+
+    def pack(self, sizes):
+        # Shelf packing, tallest images first so the images on a shelf are about the same height.
+        # Frames come back in the order of sizes
+        frames = [None] * len(sizes)
+        sheets = []
+        x = y = shelf = 0
+        for n in sorted(range(len(sizes)), key=lambda n: (-sizes[n][1], n)):
+            width, height = sizes[n]
+            if width > self.size or height > self.size:
+                raise ValueError(f'{self.keys[n][0]} is larger than the {self.size} pixel atlas')
+            if x + width > self.size:
+                x, y, shelf = 0, y + shelf, 0
+            if not sheets or y + height > self.size:
+                sheets.append([0, 0])
+                x = y = shelf = 0
+            frames[n] = [len(sheets) - 1, x, y, width, height]
+            sheets[-1][0] = max(sheets[-1][0], x + width)
+            sheets[-1][1] = max(sheets[-1][1], y + height)
+            x += width + ATLAS_PADDING
+            shelf = max(shelf, height + ATLAS_PADDING)
+        return {'sheets': sheets, 'frames': frames}
+
+    def build(self):
+        # Read every image once, scale, flip and rotate it as it is drawn and save the packed sheets, works without a window
+        sources = {}
+        for path, size, flip, rotation in self.keys:
+            if path not in sources:
+                sources[path] = pygame.image.load(path)
+        images = [AssetCache.transform(sources[path], size, flip, rotation) for path, size, flip, rotation in self.keys]
+        index = self.pack([image.get_size() for image in images])
+        index['keys'] = self.keys
+        sheets = [pygame.Surface(size, pygame.SRCALPHA, 32) for size in index['sheets']]
+        for image, (n, x, y, width, height) in zip(images, index['frames']):
+            # Blitting onto fully transparent pixels copies them as they are
+            sheets[n].blit(image, (x, y))
+        try:
+            # Fastest zlib level, a PNG decoder would take longer than reading the small images one by one
+            for n, sheet in enumerate(sheets):
+                with open(self.sheet_path(n), 'wb') as file:
+                    file.write(zlib.compress(pygame.image.tobytes(sheet, 'RGBA'), 1))
+            with open(self.path + '.json', 'w') as file:
+                json.dump(index, file)
+        except OSError:
+            # Read only installs pack the images again every run
+            pass
+        return sheets, index
+
+    def read_sheets(self, index):
+        sheets = []
+        for n, size in enumerate(index['sheets']):
+            with open(self.sheet_path(n), 'rb') as file:
+                sheets.append(pygame.image.frombuffer(zlib.decompress(file.read()), size, 'RGBA'))
+        return sheets
+
+    def load(self):
+        index = self.read_index()
+        sheets = None
+        if index is not None:
+            try:
+                sheets = self.read_sheets(index)
+            except (OSError, ValueError, zlib.error):
+                # Cut short or damaged, pack them again
+                sheets = None
+        if sheets is None:
+            sheets, index = self.build()
+        self.sheets = [sheet.convert_alpha() for sheet in sheets]
+        # Frames share the pixels of their sheet instead of each being a surface of their own
+        self.frames = {key: self.sheets[n].subsurface((x, y, width, height))
+                       for key, (n, x, y, width, height) in zip(self.keys, index['frames'])}
+
+    def frame(self, key):
+        if self.frames is None:
+            self.load()
+        return self.frames.get(key)
+
+
+class AssetCache:
+    def __init__(self, atlas=None):
+        # Packed sheets to cut images from, images not in it are made from their own file
+        self.atlas = atlas
+        # Image path -> image as loaded, read from disk the first time it is asked for
+        self.images = {}
+        # (image path, size, flip, rotation) -> shared surface
+        self.surfaces = {}
+        # (images, size, frame time, flip) -> FrameTable shared by every sprite with that look
+        self.animations = {}
+        # Surfaces made so far, should stop growing once a level is loaded
+        self.allocations = 0
+
+    def image(self, path):
+        image = self.images.get(path)
+        if image is None:
+            image = self.images[path] = load_image(path)
+        return image
+
+    @staticmethod
+    def transform(image, size=None, flip=False, rotation=0):
+        # Size is a (width, height) or a factor to scale both by
+        if size is not None and not isinstance(size, tuple):
+            size = (int(image.get_width() * size), int(image.get_height() * size))
+        if size is not None and size != image.get_size():
+            image = pygame.transform.scale(image, size)
+        if flip:
+            image = pygame.transform.flip(image, True, False)
+        if rotation:
+            image = pygame.transform.rotate(image, rotation)
+        return image
+
+    def get(self, path, size=None, flip=False, rotation=0):
+        key = (path, size, flip, rotation)
+        surface = self.surfaces.get(key)
+        if surface is None:
+            if self.atlas is not None and key in self.atlas.keys:
+                surface = self.atlas.frame(key)
+            else:
+                surface = self.transform(self.image(path), size, flip, rotation)
+            self.surfaces[key] = surface
+            self.allocations += 1
+        return surface
+
+    def animation(self, paths, size, frame_time, flip=(True, False)):
+        # Frames shared by every sprite animated from the same images, flip says which way round
+        # the right and left facing frames are drawn, enemy images face left
+        key = (tuple(paths), size, frame_time, flip)
+        table = self.animations.get(key)
+        if table is None:
+            table = self.animations[key] = FrameTable(tuple(self.get(path, size, flip=flip[0]) for path in paths),
+                                                      tuple(self.get(path, size, flip=flip[1]) for path in paths),
+                                                      frame_time)
+        return table
+
+
+class FrameTable(collections.namedtuple('FrameTable', ('right', 'left', 'frame_time'))):
+    # Right and left facing frames and the seconds each one is shown, never changed once made
+    __slots__ = ()
+
+    def frame(self, elapsed, direction=1):
+        frames = self.left if direction == -1 else self.right
+        return frames[int(elapsed / self.frame_time) % len(frames)]
+
+
+class Clock:
+    # Game time, moved on one tick at a time so headless runs and replays animate the same way
+    __slots__ = ('ticks',)
+
+    def __init__(self):
+        self.ticks = 0
+
+    def tick(self):
+        self.ticks += 1
+
+    @property
+    def time(self):
+        return self.ticks / TICK_RATE
+
+
+class Animation:
+    # Frame table or still image a sprite shows and since when, the frame is only worked out when drawn
+    __slots__ = ('clock', 'table', 'still', 'start')
+
+    def __init__(self, clock, table=None, still=None):
+        self.clock = clock
+        self.table = table
+        self.still = still
+        self.start = clock.ticks
+
+    def play(self, table):
+        # Carry on if the table is already playing, from its first frame otherwise
+        if self.table is not table:
+            self.table = table
+            self.start = self.clock.ticks
+
+    def show(self, image):
+        self.table = None
+        self.still = image
+
+    def frame(self, direction=1):
+        if self.table is None:
+            return self.still
+        return self.table.frame((self.clock.ticks - self.start) / TICK_RATE, direction)
+
+
+class TextCache:
+    def __init__(self, max_size=64):
+        # (font, text, antialias, color) -> rendered label, least recently used first
+        self.labels = collections.OrderedDict()
+        self.max_size = max_size
+        # (name, size) -> font, looking up system fonts is slow so only on first use
+        self.fonts = {}
+
+    def font(self, font):
+        loaded = self.fonts.get(font)
+        if loaded is None:
+            if not pygame.font.get_init():
+                pygame.font.init()
+            loaded = self.fonts[font] = pygame.font.SysFont(*font)
+        return loaded
+
+    def render(self, font, text, antialias, color):
+        # Only rasterize text again when it changes
+        key = (font, text, antialias, color)
+        label = self.labels.get(key)
+        if label is None:
+            label = self.font(font).render(text, antialias, color)
+            self.labels[key] = label
+            if len(self.labels) > self.max_size:
+                self.labels.popitem(last=False)
+        else:
+            self.labels.move_to_end(key)
+        return label
+
+
+# Images, loaded through ASSETS on first use
+SUN = 'images/sun.png'
+BG = 'images/backgroundForest.png'
+DIRT = 'images/snow0.png'
+GRASS = 'images/snow1.png'
+PLATFORM = 'images/snowhalf.png'
 PLAYER = {
-    'stand': [pygame.image.load(f'images/stand{n}.png') for n in range(6)],
-    'walk': [pygame.image.load(f'images/walk{n}.png') for n in range(8)],
-    'jump': pygame.image.load('images/jump0.png'),
-    'duck': pygame.image.load('images/duck.png')
+    'stand': [f'images/stand{n}.png' for n in range(6)],
+    'walk': [f'images/walk{n}.png' for n in range(8)],
+    'jump': 'images/jump0.png',
+    'duck': 'images/duck.png'
 }
 WORM = [
-    [pygame.image.load('images/worm0.png'), pygame.image.load('images/worm1.png')],
-    [pygame.image.load('images/barnacle0.png'), pygame.image.load('images/barnacle1.png')],
-    [pygame.image.load('images/frog.png'), pygame.image.load('images/frog_move.png')],
-    [pygame.image.load('images/ladybug.png'), pygame.image.load('images/ladybug_move.png')],
-    [pygame.image.load('images/mouse.png'), pygame.image.load('images/mouse_move.png')],
-    [pygame.image.load('images/sawHalf.png'), pygame.image.load('images/sawHalf_move.png')],
-    [pygame.image.load('images/slimeBlock.png'), pygame.image.load('images/slimeBlock_move.png')],
-    [pygame.image.load('images/snail.png'), pygame.image.load('images/snail_move.png')],
+    ['images/worm0.png', 'images/worm1.png'],
+    ['images/barnacle0.png', 'images/barnacle1.png'],
+    ['images/frog.png', 'images/frog_move.png'],
+    ['images/ladybug.png', 'images/ladybug_move.png'],
+    ['images/mouse.png', 'images/mouse_move.png'],
+    ['images/sawHalf.png', 'images/sawHalf_move.png'],
+    ['images/slimeBlock.png', 'images/slimeBlock_move.png'],
+    ['images/snail.png', 'images/snail_move.png'],
 ]
 FLY = [
-    [pygame.image.load('images/bee.png'), pygame.image.load('images/bee_move.png')],
-    [pygame.image.load('images/fly.png'), pygame.image.load('images/fly_move.png')],
+    ['images/bee.png', 'images/bee_move.png'],
+    ['images/fly.png', 'images/fly_move.png'],
 ]
-WATER = [pygame.image.load(f'images/water{n}.png') for n in range(2)]
-DIVE = pygame.image.load('images/dive.png')
-FELL = pygame.image.load('images/fell.png')
-ANGEL = pygame.image.load('images/angel.png')
-RESTART = pygame.image.load('images/restartbtn.png')
-FLOWER = [pygame.image.load(f'images/flower{n}.png') for n in range(7)]
-DOOR = pygame.image.load('images/door.png')
-HEALTH = pygame.image.load('images/bar.png')
+WATER = [f'images/water{n}.png' for n in range(2)]
+DIVE = 'images/dive.png'
+FELL = 'images/fell.png'
+ANGEL = 'images/angel.png'
+RESTART = 'images/restartbtn.png'
+FLOWER = [f'images/flower{n}.png' for n in range(7)]
+DOOR = 'images/door.png'
+HEALTH = 'images/bar.png'
+# Seconds each frame of an animation is shown
+WALK_FRAME_TIME = 0.08
+STAND_FRAME_TIME = 1.7
+ENEMY_FRAME_TIME = 0.18
+TEXT_CACHE = TextCache()
+
+# Sound output, samples per second and samples mixed at a time
+MIXER_FREQUENCY = 44100
+MIXER_BUFFER = 512
+
+
+class Sound:
+    # An effect with its own mixer channels, at most voices copies of it play at once
+    def __init__(self, path, volume=1.0, voices=1, steal=True):
+        self.path = path
+        self.volume = volume
+        self.voices = voices
+        # When every voice is busy, restart the oldest one instead of dropping the new play
+        self.steal = steal
+        self.sound = None
+        self.channels = []
+        self.started = []
+        AUDIO.add(self)
+
+    def play(self):
+        AUDIO.play(self)
+
+
+class SoundManager:
+    # Plays effects on reserved channels, or does nothing with the null backend used by headless runs
+    def __init__(self, history=300):
+        self.sounds = []
+        self.enabled = False
+        self.plays = 0
+        self.dropped = 0
+        self.stolen = 0
+        self.peak_voices = 0
+        # Milliseconds spent starting each sound, the game loop waits on these
+        self.latencies = collections.deque(maxlen=history)
+
+    def add(self, sound):
+        self.sounds.append(sound)
+        if self.enabled:
+            self.load(sound)
+
+    def start(self):
+        # Load every effect and give it channels no other sound can take, needs pygame.mixer.init() first
+        if not pygame.mixer.get_init():
+            return False
+        self.enabled = True
+        for sound in self.sounds:
+            sound.channels = []
+        for sound in self.sounds:
+            self.load(sound)
+        return True
+
+    def load(self, sound):
+        # Channels after the ones already handed out
+        first = sum(len(other.channels) for other in self.sounds)
+        pygame.mixer.set_num_channels(first + sound.voices)
+        pygame.mixer.set_reserved(first + sound.voices)
+        if sound.sound is None:
+            sound.sound = pygame.mixer.Sound(sound.path)
+            sound.sound.set_volume(sound.volume)
+        sound.channels = [pygame.mixer.Channel(n) for n in range(first, first + sound.voices)]
+        sound.started = [0.0] * sound.voices
+
+    def stop(self):
+        # Switch to the null backend, effects stay loaded for when sound starts again
+        self.enabled = False
+
+    def play(self, sound):
+        self.plays += 1
+        if not self.enabled:
+            return
+        start = time.perf_counter()
+        free = [n for n, channel in enumerate(sound.channels) if not channel.get_busy()]
+        if free:
+            voice = free[0]
+        elif sound.steal:
+            voice = sound.started.index(min(sound.started))
+            self.stolen += 1
+        else:
+            self.dropped += 1
+            return
+        sound.channels[voice].play(sound.sound)
+        sound.started[voice] = start
+        self.peak_voices = max(self.peak_voices, self.voices())
+        self.latencies.append((time.perf_counter() - start) * 1000)
+
+    def voices(self):
+        return sum(channel.get_busy() for sound in self.sounds for channel in sound.channels)
+
+    def metrics(self):
+        latencies = sorted(self.latencies)
+        return {
+            'plays': self.plays,
+            'dropped': self.dropped,
+            'stolen': self.stolen,
+            'voices': self.voices() if self.enabled else 0,
+            'peak_voices': self.peak_voices,
+            'p95_play_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0,
+            'buffer_ms': MIXER_BUFFER / MIXER_FREQUENCY * 1000 if self.enabled else 0.0,
+        }
+
+
+AUDIO = SoundManager()
 
 # Sounds
-SCORE_FX = pygame.mixer.Sound('sounds/score.wav')
-SCORE_FX.set_volume(0.5)
-JUMP_FX = pygame.mixer.Sound('sounds/jump.wav')
-JUMP_FX.set_volume(0.5)
-GAME_OVER_FX = pygame.mixer.Sound('sounds/game_over.wav')
-GAME_OVER_FX.set_volume(0.5)
+SCORE_FX = Sound('sounds/score.wav', 0.5, voices=2)
+JUMP_FX = Sound('sounds/jump.wav', 0.5)
+GAME_OVER_FX = Sound('sounds/game_over.wav', 0.5, steal=False)
 
 # Music
 # pygame.mixer.music.load('sounds/music.wav')
@@ -73,112 +509,569 @@ GAME_OVER_FX.set_volume(0.5)
 
 # Tile settings
 TILE_SIZE = 50
+# Sizes sprites are drawn at
+PLAYER_SIZE = (40, 50)
+ENEMY_SIZE = (TILE_SIZE - 20, TILE_SIZE - 20)
+FLOWER_SIZE = (TILE_SIZE // 3, TILE_SIZE // 3)
+PLATFORM_SIZE = (TILE_SIZE, TILE_SIZE // 2)
+# Tiles per side of a baked tile layer chunk
+CHUNK_SIZE = 16
+# Where the player starts every level
+START_POS = (100, HEIGHT - 50)
+
+# Every image drawn from the atlas as (path, size, flip, rotation), the way AssetCache.get() is asked for it.
+# Images left out are made from their own file, the background is as big as a sheet on its own
+ATLAS = Atlas('images/atlas', [
+    (SUN, None, False, 0), (RESTART, None, False, 0), (DOOR, None, False, 0),
+    *((path, (TILE_SIZE, TILE_SIZE), False, 0) for path in (DIRT, GRASS, *WATER, DOOR)),
+    (PLATFORM, PLATFORM_SIZE, False, 0),
+    *((path, PLAYER_SIZE, False, 0) for path in (*PLAYER['stand'], PLAYER['jump'], PLAYER['duck'])),
+    *((path, PLAYER_SIZE, flip, 0) for path in PLAYER['walk'] for flip in (False, True)),
+    *((DIVE, PLAYER_SIZE, False, rotation) for rotation in (0, 90, 180, 270)),
+    (ANGEL, (50, 50), False, 0),
+    *((path, ENEMY_SIZE, flip, 0) for paths in WORM + FLY for path in paths for flip in (True, False)),
+    *((path, FLOWER_SIZE, False, 0) for path in FLOWER),
+    # Menu
+    (PLAYER['stand'][5], (90, 110), False, 0),
+    *((path, 0.5, False, 0) for path in (FLOWER[0], WORM[0][0], FLY[0][0], WATER[0], HEALTH)),
+])
+ASSETS = AssetCache(ATLAS)
+
+
+class SpatialGrid:
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        # Cell (column, row) -> [(insertion order, item)], a list as most cells only hold one or two items
+        self.cells = {}
+        # Item id -> (entry, cell range) for the cells the item currently covers
+        self.item_cells = {}
+        self.order = 0
+
+    def cell_range(self, rect):
+        # Leftmost, rightmost, top and bottom cell the rect covers
+        return (rect.left // self.cell_size, (rect.right - 1) // self.cell_size,
+                rect.top // self.cell_size, (rect.bottom - 1) // self.cell_size)
+
+    def cells_for(self, cell_range):
+        left, right, top, bottom = cell_range
+        return [(column, row) for row in range(top, bottom + 1) for column in range(left, right + 1)]
+
+    def insert(self, item, rect):
+        cell_range = self.cell_range(rect)
+        entry = (self.order, item)
+        self.order += 1
+        for cell in self.cells_for(cell_range):
+            self.cells.setdefault(cell, []).append(entry)
+        self.item_cells[id(item)] = (entry, cell_range)
+
+    def remove(self, item):
+        entry, cell_range = self.item_cells.pop(id(item))
+        for cell in self.cells_for(cell_range):
+            bucket = self.cells[cell]
+            bucket.remove(entry)
+            if not bucket:
+                del self.cells[cell]
+
+    def move(self, item, rect):
+        # Re-bucket a moving item, most ticks it stays in the same cells and nothing is built
+        entry, old_range = self.item_cells[id(item)]
+        cell_range = self.cell_range(rect)
+        if cell_range == old_range:
+            return
+        for cell in self.cells_for(old_range):
+            bucket = self.cells[cell]
+            bucket.remove(entry)
+            if not bucket:
+                del self.cells[cell]
+        for cell in self.cells_for(cell_range):
+            self.cells.setdefault(cell, []).append(entry)
+        self.item_cells[id(item)] = (entry, cell_range)
+
+    def query(self, rect, ordered=True):
+        # Items in the cells the rect covers, in insertion order unless the caller doesn't care.
+        # Keyed by insertion order, so an item covering several cells is found once
+        found = {}
+        for cell in self.cells_for(self.cell_range(rect)):
+            bucket = self.cells.get(cell)
+            if bucket:
+                found.update(bucket)
+        if not ordered:
+            return list(found.values())
+        return [found[order] for order in sorted(found)]
+
+
+class LevelError(ValueError):
+    pass
+
+
+class SafeUnpickler(pickle.Unpickler):
+    # Old levels are plain lists of ints, anything that needs a class is refused
+    def find_class(self, module, name):
+        raise LevelError(f'level pickle refers to {module}.{name}')
+
+
+class Level:
+    # Tile codes as one flat row after row buffer of signed bytes
+    MAGIC = b'PLVL'
+    VERSION = 1
+    # Magic, version, bytes per tile, width, height
+    HEADER = struct.Struct('<4sBBHH')
+    TILE_CODES = frozenset(range(-1, 12))
+
+    def __init__(self, width, height, tiles):
+        self.width = width
+        self.height = height
+        self.tiles = tiles
+
+    @classmethod
+    def from_rows(cls, rows):
+        width = len(rows[0]) if rows else 0
+        if any(len(row) != width for row in rows):
+            raise LevelError('level rows have different lengths')
+        level = cls(width, len(rows), array.array('b', [tile for row in rows for tile in row]))
+        level.validate()
+        return level
+
+    @classmethod
+    def from_pickle(cls, path):
+        # Import a level from the old pickled list of rows
+        with open(path, 'rb') as pickle_in:
+            try:
+                rows = SafeUnpickler(pickle_in).load()
+            except (pickle.UnpicklingError, EOFError) as error:
+                raise LevelError(f'{path}: {error}') from error
+        if not isinstance(rows, list) or not all(isinstance(row, list) for row in rows):
+            raise LevelError(f'{path} is not a list of rows')
+        try:
+            return cls.from_rows(rows)
+        except (TypeError, OverflowError) as error:
+            raise LevelError(f'{path}: {error}') from error
+
+    @classmethod
+    def load(cls, path):
+        # Map the file into memory, the tiles are read straight from the mapping
+        with open(path, 'rb') as level_in:
+            try:
+                data = mmap.mmap(level_in.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise LevelError(f'{path} is empty') from None
+        if len(data) < cls.HEADER.size:
+            raise LevelError(f'{path} is too short for a level header')
+        magic, version, tile_size, width, height = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise LevelError(f'{path} is not a level file')
+        if version != cls.VERSION or tile_size != 1:
+            raise LevelError(f'{path} has unsupported version {version} with {tile_size} byte tiles')
+        if len(data) - cls.HEADER.size != width * height:
+            raise LevelError(f'{path} should have {width * height} tiles, found {len(data) - cls.HEADER.size}')
+        level = cls(width, height, memoryview(data)[cls.HEADER.size:].cast('b'))
+        level.validate(path)
+        return level
+
+    def validate(self, name='level'):
+        unknown = set(self.tiles) - self.TILE_CODES
+        if unknown:
+            raise LevelError(f'{name} has unknown tile codes {sorted(unknown)}')
+
+    def save(self, path):
+        with open(path, 'wb') as level_out:
+            level_out.write(self.HEADER.pack(self.MAGIC, self.VERSION, 1, self.width, self.height))
+            level_out.write(bytes(self.tiles))
+
+    def rows(self):
+        return [list(self.tiles[row * self.width:(row + 1) * self.width]) for row in range(self.height)]
+
+
+class Chunk:
+    def __init__(self, key, rect):
+        self.key = key
+        self.rect = rect
+        self.loaded = False
+        # (group, sprite) pairs, kept while unloaded so enemies and picked flowers stay as they were
+        self.sprites = []
+        # Cells of water and door tiles taken out of their group, the rest is read from the level again
+        self.removed = set()
+        # Only while loaded: tile rects row by row, the image baked for each tile cell and the baked layers.
+        # Water and doors are only in their tile groups
+        self.tiles = []
+        self.tile_images = {}
+        self.layers = []
 
 
-class World:
-    def __init__(self, data):
-        self.tiles = []
+class Camera:
+    def __init__(self, bounds, width=WIDTH, height=HEIGHT):
+        # Area the camera may show, in world pixels
+        self.bounds = bounds
+        self.width = width
+        self.height = height
+        self.offset = (bounds.x, bounds.y)
+        self.previous = self.offset
+
+    @property
+    def view(self):
+        return pygame.Rect(self.offset, (self.width, self.height))
+
+    def follow(self, rect):
+        # Keep the target centered, without showing anything outside the bounds
+        self.previous = self.offset
+        self.offset = (self.clamp(rect.centerx - self.width // 2, self.bounds.left, self.bounds.width, self.width),
+                       self.clamp(rect.centery - self.height // 2, self.bounds.top, self.bounds.height, self.height))
+
+    def snap(self, rect):
+        # Jump straight to the target, for a new level
+        self.follow(rect)
+        self.previous = self.offset
+
+    @staticmethod
+    def clamp(position, start, length, size):
+        if length <= size:
+            return start + (length - size) // 2
+        return max(start, min(position, start + length - size))
 
-        # Sprite groups
-        self.worm_group = pygame.sprite.Group()
-        self.fly_group = pygame.sprite.Group()
-        self.water_group = pygame.sprite.Group()
-        self.under_water_group = pygame.sprite.Group()
+    def interpolate(self, alpha):
+        x, y = self.previous
+        return round(x + (self.offset[0] - x) * alpha), round(y + (self.offset[1] - y) * alpha)
+
+
+class World:
+    SOLID_TILES = (0, 1)
+    # Water and door tile codes and the contacts() kind they are found as
+    TILE_KINDS = {2: 'water', 3: 'water', 4: 'under_water', 10: 'door'}
+
+    def __init__(self, level, rng=random, start=START_POS):
+        self.level = level
+        self.width = level.width * TILE_SIZE
+        self.height = level.height * TILE_SIZE
+
+        # Chunks are made on first use and loaded or unloaded as the camera moves
+        self.chunks = {}
+        self.loaded = set()
+        self.chunk_columns = -(-level.width // CHUNK_SIZE)
+        self.chunk_rows = -(-level.height // CHUNK_SIZE)
+        # Changes whenever chunks load or unload or the doors go
+        self.version = 0
+        # Chunk columns and rows stream() kept loaded last time
+        self.streamed = None
+        # (version and cell range, (kind, rect) pairs) of the water and door tiles contacts() found last
+        self.tile_contacts = (None, [])
+        # Every chunk gets its own rng, so sprites look the same whatever order chunks load in
+        self.chunk_seed = rng.getrandbits(64)
+
+        # Collision lookup, so the player only checks tiles and platforms around it
+        self.tile_grid = SpatialGrid(TILE_SIZE)
+        self.platform_grid = SpatialGrid(TILE_SIZE)
+        # Enemies and flowers, looked up once a tick by contacts()
+        self.sprite_grid = SpatialGrid(TILE_SIZE)
+        # Item id -> the group it is in
+        self.sprite_groups = {}
+        # Enemies animate by this, moved on by Game.update_sprites()
+        self.clock = Clock()
+
+        # Sprite groups, only sprites of loaded chunks are in them
+        self.worm_group = EntityGroup()
+        self.fly_group = EntityGroup()
+        self.water_group = TileGroup()
+        self.under_water_group = TileGroup()
         self.flower_group = pygame.sprite.Group()
-        self.platform_group = pygame.sprite.Group()
-        self.door_group = pygame.sprite.Group()
-
-        # World items
-        rows = 0
-        for row in data:
-            columns = 0
-            for tile in row:
-                if tile == 0:
-                    img = pygame.transform.scale(DIRT, (TILE_SIZE, TILE_SIZE))
-                    img_rect = img.get_rect()
-                    img_rect.x = columns * TILE_SIZE
-                    img_rect.y = rows * TILE_SIZE
-                    tile = (img, img_rect)
-                    self.tiles.append(tile)
-                if tile == 1:
-                    img = pygame.transform.scale(GRASS, (TILE_SIZE, TILE_SIZE))
-                    img_rect = img.get_rect()
-                    img_rect.x = columns * TILE_SIZE
-                    img_rect.y = rows * TILE_SIZE
-                    tile = (img, img_rect)
-                    self.tiles.append(tile)
-                if tile == 2:
-                    water = Water(columns * TILE_SIZE, rows * TILE_SIZE)
-                    self.water_group.add(water)
-                if tile == 3:
-                    water = DeepWater(columns * TILE_SIZE, rows * TILE_SIZE)
-                    self.water_group.add(water)
-                if tile == 4:
-                    water = DeepWater(columns * TILE_SIZE, rows * TILE_SIZE)
-                    self.under_water_group.add(water)
-                if tile == 5:
-                    worm = Worm(columns * TILE_SIZE + 20, rows * TILE_SIZE + 20)
-                    self.worm_group.add(worm)
-                if tile == 6:
-                    flower = Flower(columns * TILE_SIZE + TILE_SIZE // 2, rows * TILE_SIZE + TILE_SIZE - 8)
-                    self.flower_group.add(flower)
-                if tile == 7:
-                    # Tile move x axis
-                    platform = Platform(columns * TILE_SIZE, rows * TILE_SIZE, True, False)
-                    self.platform_group.add(platform)
-                if tile == 8:
-                    # Tile move y axis
-                    platform = Platform(columns * TILE_SIZE, rows * TILE_SIZE, False, True)
-                    self.platform_group.add(platform)
-                if tile == 9:
-                    # Fly move x axis
-                    fly = Fly(columns * TILE_SIZE + 20, rows * TILE_SIZE + 20, True, False)
-                    self.fly_group.add(fly)
-                if tile == 10:
-                    door = Door(columns * TILE_SIZE, rows * TILE_SIZE)
-                    self.door_group.add(door)
-                if tile == 11:
-                    # Fly move y axis
-                    fly = Fly(columns * TILE_SIZE + 20, rows * TILE_SIZE + 20, False, True)
-                    self.fly_group.add(fly)
-                columns += 1
-            rows += 1
+        self.platform_group = EntityGroup()
+        self.door_group = TileGroup()
+        self.kinds = {self.water_group: 'water', self.under_water_group: 'under_water', self.worm_group: 'worm',
+                      self.fly_group: 'fly', self.flower_group: 'flower', self.door_group: 'door'}
+
+        self.bounds = self.reachable_bounds(start)
+
+    def reachable_bounds(self, start):
+        # Camera limits: the open area around the start and the walls around it
+        level = self.level
+        level_rect = pygame.Rect(0, 0, self.width, self.height)
+        column = start[0] // TILE_SIZE
+        row = start[1] // TILE_SIZE
+        # The player starts inside the floor, look upwards for open space
+        while 0 <= column < level.width and 0 <= row < level.height and level.tiles[row * level.width + column] in self.SOLID_TILES:
+            row -= 1
+        if not (0 <= column < level.width and 0 <= row < level.height):
+            return level_rect
+
+        seen = bytearray(level.width * level.height)
+        seen[row * level.width + column] = 1
+        stack = [(column, row)]
+        left = right = column
+        top = bottom = row
+        while stack:
+            column, row = stack.pop()
+            left = min(left, column)
+            right = max(right, column)
+            top = min(top, row)
+            bottom = max(bottom, row)
+            for next_column, next_row in ((column - 1, row), (column + 1, row), (column, row - 1), (column, row + 1)):
+                if 0 <= next_column < level.width and 0 <= next_row < level.height:
+                    index = next_row * level.width + next_column
+                    if not seen[index] and level.tiles[index] not in self.SOLID_TILES:
+                        seen[index] = 1
+                        stack.append((next_column, next_row))
+        return pygame.Rect((left - 1) * TILE_SIZE, (top - 1) * TILE_SIZE,
+                           (right - left + 3) * TILE_SIZE, (bottom - top + 3) * TILE_SIZE).clip(level_rect)
+
+    def stream(self, view):
+        # Keep the chunks under the view and one chunk around it loaded
+        size = CHUNK_SIZE * TILE_SIZE
+        area = view.inflate(size * 2, size * 2)
+        columns = range(max(0, area.left // size), min(self.chunk_columns, (area.right - 1) // size + 1))
+        rows = range(max(0, area.top // size), min(self.chunk_rows, (area.bottom - 1) // size + 1))
+        # Most ticks the camera stays within the same chunks
+        if (columns, rows) == self.streamed:
+            return
+        self.streamed = (columns, rows)
+        keys = {(column, row) for row in rows for column in columns}
+        for key in sorted(self.loaded - keys):
+            self.unload_chunk(key)
+        for key in sorted(keys - self.loaded):
+            self.load_chunk(key)
+
+    def chunk_cells(self, key):
+        # Column, row and code of every tile in the chunk, read row after row from the flat tile buffer
+        level = self.level
+        first_column = key[0] * CHUNK_SIZE
+        last_column = min(first_column + CHUNK_SIZE, level.width)
+        for rows in range(key[1] * CHUNK_SIZE, min((key[1] + 1) * CHUNK_SIZE, level.height)):
+            row_start = rows * level.width
+            for columns, tile in enumerate(level.tiles[row_start + first_column:row_start + last_column], first_column):
+                if tile != -1:
+                    yield columns, rows, tile
+
+    def make_chunk(self, key):
+        rng = random.Random(f'{self.chunk_seed}:{key[0]}:{key[1]}')
+        chunk = Chunk(key, pygame.Rect(key[0] * CHUNK_SIZE * TILE_SIZE, key[1] * CHUNK_SIZE * TILE_SIZE,
+                                       CHUNK_SIZE * TILE_SIZE, CHUNK_SIZE * TILE_SIZE))
+
+        # Sprites, made once and kept with the chunk
+        for columns, rows, tile in self.chunk_cells(key):
+            if tile == 5:
+                worm = Worm(columns * TILE_SIZE + 20, rows * TILE_SIZE + 20, rng, self.sprite_grid, self.clock)
+                chunk.sprites.append((self.worm_group, worm))
+            if tile == 6:
+                flower = Flower(columns * TILE_SIZE + TILE_SIZE // 2, rows * TILE_SIZE + TILE_SIZE - 8, rng)
+                chunk.sprites.append((self.flower_group, flower))
+            if tile == 7:
+                # Tile move x axis
+                platform = Platform(columns * TILE_SIZE, rows * TILE_SIZE, True, False, self.platform_grid)
+                chunk.sprites.append((self.platform_group, platform))
+            if tile == 8:
+                # Tile move y axis
+                platform = Platform(columns * TILE_SIZE, rows * TILE_SIZE, False, True, self.platform_grid)
+                chunk.sprites.append((self.platform_group, platform))
+            if tile == 9:
+                # Fly move x axis
+                fly = Fly(columns * TILE_SIZE + 20, rows * TILE_SIZE + 20, True, False, rng, self.sprite_grid, self.clock)
+                chunk.sprites.append((self.fly_group, fly))
+            if tile == 11:
+                # Fly move y axis
+                fly = Fly(columns * TILE_SIZE + 20, rows * TILE_SIZE + 20, False, True, rng, self.sprite_grid, self.clock)
+                chunk.sprites.append((self.fly_group, fly))
+        return chunk
+
+    def build_tiles(self, chunk):
+        # Tiles never change, so they are read from the level every time the chunk loads.
+        # Tile images are baked into the tile layer
+        dirt = ASSETS.get(DIRT, (TILE_SIZE, TILE_SIZE))
+        grass = ASSETS.get(GRASS, (TILE_SIZE, TILE_SIZE))
+        water = ASSETS.get(WATER[0], (TILE_SIZE, TILE_SIZE))
+        deep_water = ASSETS.get(WATER[1], (TILE_SIZE, TILE_SIZE))
+        door = ASSETS.get(DOOR, (TILE_SIZE, TILE_SIZE))
+        for columns, rows, tile in self.chunk_cells(chunk.key):
+            if tile not in (0, 1, 2, 3, 4, 10) or (columns, rows) in chunk.removed:
+                continue
+            x = columns * TILE_SIZE
+            y = rows * TILE_SIZE
+            if tile == 0 or tile == 1:
+                chunk.tiles.append(pygame.Rect(x, y, TILE_SIZE, TILE_SIZE))
+                chunk.tile_images[(columns, rows)] = dirt if tile == 0 else grass
+            if tile == 2:
+                self.water_group.add(water, x, y)
+            if tile == 3:
+                self.water_group.add(deep_water, x, y)
+            if tile == 4:
+                self.under_water_group.add(deep_water, x, y)
+            if tile == 10:
+                self.door_group.add(door, x, y)
+
+    def load_chunk(self, key):
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            chunk = self.chunks[key] = self.make_chunk(key)
+        self.build_tiles(chunk)
+        chunk.layers = self.bake_layers(chunk.tile_images)
+        for rect in chunk.tiles:
+            self.tile_grid.insert(rect, rect)
+        for group, sprite in chunk.sprites:
+            group.add(sprite)
+            if group is self.platform_group:
+                self.platform_grid.insert(sprite, sprite.rect)
+            else:
+                self.sprite_grid.insert(sprite, sprite.rect)
+                self.sprite_groups[id(sprite)] = group
+        chunk.loaded = True
+        self.loaded.add(key)
+        self.version += 1
+
+    def unload_chunk(self, key):
+        # Drop the tiles and baked layer and take the chunk out of collision and updates
+        chunk = self.chunks[key]
+        for rect in chunk.tiles:
+            self.tile_grid.remove(rect)
+        for group, sprite in chunk.sprites:
+            if group is self.platform_group:
+                self.platform_grid.remove(sprite)
+            else:
+                self.sprite_grid.remove(sprite)
+                del self.sprite_groups[id(sprite)]
+        # Enemies and platforms move, so chunks with them are kept. So are chunks with a picked flower
+        # or removed door, those are gone for good. Anything else is made the same again next time
+        changed = chunk.removed or any(group is not self.flower_group or not sprite.alive()
+                                       for group, sprite in chunk.sprites)
+        chunk.sprites = [(group, sprite) for group, sprite in chunk.sprites if sprite.alive()]
+        for group, sprite in chunk.sprites:
+            group.remove(sprite)
+        size = CHUNK_SIZE * TILE_SIZE
+        area = pygame.Rect(key[0] * size, key[1] * size, size, size)
+        for group in (self.water_group, self.under_water_group, self.door_group):
+            group.remove_area(area)
+        if not changed:
+            del self.chunks[key]
+        chunk.tiles = []
+        chunk.tile_images = {}
+        chunk.layers = []
+        chunk.loaded = False
+        self.loaded.discard(key)
+        self.version += 1
+
+    def contacts(self, rect):
+        # Broadphase: every live sprite near rect by kind from one grid query, and the water and door
+        # tiles under rect read from the level, the only time rects are made for them
+        found = {kind: [] for kind in self.kinds.values()}
+        # Every kind is only checked for any hit, so the order found doesn't matter
+        for item in self.sprite_grid.query(rect, ordered=False):
+            # Picked flowers stay in the grid until their chunk unloads
+            if item.alive():
+                found[self.kinds[self.sprite_groups[id(item)]]].append(item)
+        # The player stays over the same cells for a few ticks, the tiles there only change with the world
+        key = (self.version, rect.left // TILE_SIZE, (rect.right - 1) // TILE_SIZE,
+               rect.top // TILE_SIZE, (rect.bottom - 1) // TILE_SIZE)
+        if key != self.tile_contacts[0]:
+            level = self.level
+            version, left, right, top, bottom = key
+            left = max(left, 0)
+            right = min(right + 1, level.width)
+            tiles = []
+            for rows in range(max(top, 0), min(bottom + 1, level.height)):
+                row_start = rows * level.width
+                for columns, tile in enumerate(level.tiles[row_start + left:row_start + right], left):
+                    if tile not in self.TILE_KINDS:
+                        continue
+                    # Only tiles of loaded chunks, like the sprites, and not the doors already taken out
+                    chunk = self.chunks.get((columns // CHUNK_SIZE, rows // CHUNK_SIZE))
+                    if chunk is not None and chunk.loaded and (columns, rows) not in chunk.removed:
+                        tiles.append((self.TILE_KINDS[tile], pygame.Rect(columns * TILE_SIZE, rows * TILE_SIZE,
+                                                                         TILE_SIZE, TILE_SIZE)))
+            self.tile_contacts = (key, tiles)
+        for kind, tile in self.tile_contacts[1]:
+            found[kind].append(tile)
+        return found
+
+    def remove_doors(self):
+        # Take the doors out for good, once the level is finished
+        size = CHUNK_SIZE * TILE_SIZE
+        for rect in self.door_group:
+            self.chunks[(rect.x // size, rect.y // size)].removed.add((rect.x // TILE_SIZE, rect.y // TILE_SIZE))
+        self.door_group.empty()
+        self.version += 1
+
+    def bake_layers(self, tile_images):
+        # Merge the chunk's tiles into solid rectangles, each baked into one surface
+        runs = []
+        for row in sorted({row for column, row in tile_images}):
+            # Horizontal runs in every row
+            columns = sorted(column for column, cell_row in tile_images if cell_row == row)
+            start = columns[0]
+            for previous, column in zip(columns, columns[1:] + [None]):
+                if column != previous + 1:
+                    runs.append((row, start, previous))
+                    start = column
+
+        # Stack runs with the same columns on top of each other
+        blocks = {}
+        for row, start, end in runs:
+            block = blocks.get((start, end))
+            if block and block[-1][1] == row - 1:
+                block[-1][1] = row
+            else:
+                blocks.setdefault((start, end), []).append([row, row])
 
-    def draw(self, window):
-        for tile in self.tiles:
-            window.blit(tile[0], tile[1])
+        layers = []
+        for (start, end), spans in blocks.items():
+            for top, bottom in spans:
+                rect = pygame.Rect(start * TILE_SIZE, top * TILE_SIZE,
+                                   (end - start + 1) * TILE_SIZE, (bottom - top + 1) * TILE_SIZE)
+                layer = pygame.Surface(rect.size).convert()
+                for row in range(top, bottom + 1):
+                    for column in range(start, end + 1):
+                        layer.blit(tile_images[(column, row)],
+                                   ((column - start) * TILE_SIZE, (row - top) * TILE_SIZE))
+                layers.append((layer, rect))
+        return layers
 
-            # Grid lines
-            # pygame.draw.rect(window, (255, 255, 255), tile[1], 2)
+    def draw(self, window, offset=(0, 0)):
+        for key in self.loaded:
+            for layer, rect in self.chunks[key].layers:
+                window.blit(layer, rect.move(-offset[0], -offset[1]))
 
+                # Grid lines
+                # pygame.draw.rect(window, (255, 255, 255), rect.move(-offset[0], -offset[1]), 2)
 
-def grid_lines():
-    for line in range(0, 20):
-        pygame.draw.line(WIN, (255, 255, 255), (0, line * TILE_SIZE), (WIDTH, line * TILE_SIZE))
-        pygame.draw.line(WIN, (255, 255, 255), (line * TILE_SIZE, 0), (line * TILE_SIZE, HEIGHT))
+
+def grid_lines(offset=(0, 0)):
+    for line in range(-offset[1] % TILE_SIZE, HEIGHT, TILE_SIZE):
+        pygame.draw.line(WIN, (255, 255, 255), (0, line), (WIDTH, line))
+    for line in range(-offset[0] % TILE_SIZE, WIDTH, TILE_SIZE):
+        pygame.draw.line(WIN, (255, 255, 255), (line, 0), (line, HEIGHT))
+
+
+def interpolate(sprite, alpha):
+    # Drawing position between the sprite's last two ticks
+    x, y = sprite.previous
+    return round(x + (sprite.rect.x - x) * alpha), round(y + (sprite.rect.y - y) * alpha)
 
 
 class Character:
+    # Size of every frame, and of the collision rect
+    char_size = PLAYER_SIZE
+
     def __init__(self, health=50):
-        # Images
+        # Images, walking and standing frames are shared with every character
         self.health = health
-        self.walk_right = []
-        self.walk_left = []
-        self.stand = []
-        self.char_size = (40, 50)
-        self.jump = pygame.transform.scale(PLAYER['jump'], self.char_size)
-        self.dive = pygame.transform.scale(DIVE, self.char_size)
-        self.angel = pygame.transform.scale(ANGEL, (50, 50))
-        self.duck = pygame.transform.scale(PLAYER['duck'], self.char_size)
-        for n in range(8):
-            walk = pygame.transform.scale(PLAYER['walk'][n], self.char_size)
-            self.walk_right.append(walk)
-            self.walk_left.append(pygame.transform.flip(walk, True, False))
-        for n in range(6):
-            stand = pygame.transform.scale(PLAYER['stand'][n], self.char_size)
-            self.stand.append(stand)
-        self.image = self.stand[1]
+        self.walk = ASSETS.animation(PLAYER['walk'], self.char_size, WALK_FRAME_TIME, flip=(False, True))
+        self.stand = ASSETS.animation(PLAYER['stand'], self.char_size, STAND_FRAME_TIME, flip=(False, False))
+        self.jump = ASSETS.get(PLAYER['jump'], self.char_size)
+        self.dive = ASSETS.get(DIVE, self.char_size)
+        self.swim_up = ASSETS.get(DIVE, self.char_size, rotation=180)
+        self.swim_right = ASSETS.get(DIVE, self.char_size, rotation=90)
+        self.swim_left = ASSETS.get(DIVE, self.char_size, rotation=270)
+        self.angel = ASSETS.get(ANGEL, (50, 50))
+        self.duck = ASSETS.get(PLAYER['duck'], self.char_size)
+        # Moved on a tick at a time by Game.update_player()
+        self.clock = Clock()
+        self.direction = 0
+        self.animation = Animation(self.clock, still=self.stand.right[1])
         self.rect = self.image.get_rect()
+        self.previous = self.rect.topleft
+
+    @property
+    def image(self):
+        return self.animation.frame(self.direction)
+
+    @image.setter
+    def image(self, image):
+        self.animation.show(image)
 
     def get_width(self):
         return self.image.get_width()
@@ -186,38 +1079,44 @@ class Character:
     def get_height(self):
         return self.image.get_height()
 
-    def draw(self, window):
+    def draw(self, window, alpha=1, offset=(0, 0)):
         # Draw Character onto screen
-        window.blit(self.image, self.rect)
+        x, y = interpolate(self, alpha)
+        return window.blit(self.image, (x - offset[0], y - offset[1]))
 
 
 class Player(Character):
+    # Movement in pixels per tick, analyze_levels.py plans jumps with the same numbers
+    WALKING_SPEED = 4
+    JUMP_SPEED = -15
+    GRAVITY = 1
+    MAX_FALL_SPEED = 10
+    # Platforms catch the player from this far above or below
+    COLLISION_RANGE = 20
+
     def __init__(self, x, y, health=50):
         super().__init__(health)
         self.rect.x = x
         self.rect.y = y
+        self.previous = self.rect.topleft
         self.vel_y = 0
-        self.index = 0
         self.counter = 0
-        self.direction = 0
         self.jumped = False
-        self.idle = 0
-        self.still = 0
         self.in_air = False
         self.max_health = 100
 
-    def controls(self, world):
+    def controls(self, world, key=None):
         delta_x = 0
         delta_y = 0
-        walking_speed = 4
-        collision_range = 20
+        walking_speed = self.WALKING_SPEED
+        collision_range = self.COLLISION_RANGE
 
-        # Animation speed
+        # Steps before the walking frames take over from a jump, duck or swimming image
         walking_delay = 4
-        standing_delay = 100
 
         # Player controls
-        key = pygame.key.get_pressed()
+        if key is None:
+            key = pygame.key.get_pressed()
 
         if key[pygame.K_LEFT]:
             delta_x -= walking_speed
@@ -230,7 +1129,7 @@ class Player(Character):
             self.direction = 1
 
         if key[pygame.K_UP] and not self.jumped and not self.in_air:
-            self.vel_y = -15
+            self.vel_y = self.JUMP_SPEED
             self.jumped = True
             self.image = self.jump
             JUMP_FX.play()
@@ -242,58 +1141,51 @@ class Player(Character):
             self.image = self.duck
 
         if not key[pygame.K_LEFT] and not key[pygame.K_RIGHT] and not key[pygame.K_UP] and not key[pygame.K_DOWN]:
-            self.idle += 1
-            self.image = self.stand[self.still]
+            self.animation.play(self.stand)
 
-        # Walking Animation
+        # Walking animation, facing the way the player last went. The collision box is the image's size,
+        # so a sideways swimming image stays on until then like it always has
         if self.counter > walking_delay:
             self.counter = 0
-            self.index += 1
-            if self.index >= len(self.walk_right):
-                self.index = 0
-            if self.direction == 1:
-                self.image = self.walk_right[self.index]
-            if self.direction == -1:
-                self.image = self.walk_left[self.index]
-
-        # Standing animation
-        if self.idle > standing_delay:
-            self.idle = 0
-            self.still += 1
-            if self.still >= len(self.stand):
-                self.still = 0
+            self.animation.play(self.walk)
 
         # Gravity
-        self.vel_y += 1
-        if self.vel_y > 10:
-            self.vel_y = 10
+        self.vel_y += self.GRAVITY
+        if self.vel_y > self.MAX_FALL_SPEED:
+            self.vel_y = self.MAX_FALL_SPEED
         delta_y += self.vel_y
 
+        # Area the player can touch this frame, only tiles and platforms in its cells are checked
+        swept_rect = self.rect.union(self.rect.move(delta_x, delta_y)).inflate(collision_range * 2, collision_range * 2)
+
+        # Collision box, the image doesn't change while it is checked
+        width, height = self.image.get_size()
+
         # Collision with walls
         self.in_air = True
-        for tile in world.tiles:
+        for tile in world.tile_grid.query(swept_rect):
             # Check for collision in x direction, collision between rectangles
-            if tile[1].colliderect(self.rect.x + delta_x, self.rect.y, self.get_width(), self.get_height()):
+            if tile.colliderect(self.rect.x + delta_x, self.rect.y, width, height):
                 delta_x = 0
             # Check for collision in y direction
-            if tile[1].colliderect(self.rect.x, self.rect.y + delta_y, self.get_width(), self.get_height()):
+            if tile.colliderect(self.rect.x, self.rect.y + delta_y, width, height):
                 # Check if below the ground i.e. jumping
                 if self.vel_y < 0:
-                    delta_y = tile[1].bottom - self.rect.top
+                    delta_y = tile.bottom - self.rect.top
                     self.vel_y = 0
                 # Check if above the ground i.e. falling
                 elif self.vel_y >= 0:
-                    delta_y = tile[1].top - self.rect.bottom
+                    delta_y = tile.top - self.rect.bottom
                     self.vel_y = 0
                     self.in_air = False
 
         # Collision with platforms
-        for platform in world.platform_group:
+        for platform in world.platform_grid.query(swept_rect):
             # Collision in x axis
-            if platform.rect.colliderect(self.rect.x + delta_x, self.rect.y, self.get_width(), self.get_height()):
+            if platform.rect.colliderect(self.rect.x + delta_x, self.rect.y, width, height):
                 delta_x = 0
             # Collision in y axis
-            if platform.rect.colliderect(self.rect.x, self.rect.y + delta_y, self.get_width(), self.get_height()):
+            if platform.rect.colliderect(self.rect.x, self.rect.y + delta_y, width, height):
                 # Check if below platform
                 if abs((self.rect.top + delta_y) - platform.rect.bottom) < collision_range:
                     # If player hit her hed in platform, stop upside movement
@@ -319,21 +1211,25 @@ class Player(Character):
         #     self.rect.bottom = HEIGHT - 50
         #     # delta_y = 0
 
-    def swim(self, world):
-        keys = pygame.key.get_pressed()
+    def swim(self, world, keys=None):
+        if keys is None:
+            keys = pygame.key.get_pressed()
         delta_x = 0
         delta_y = 0
         self.image = self.dive
         can_move = True
 
-        for tile in world.tiles:
+        width, height = self.image.get_size()
+
+        # Every tile pushes the player a pixel, so look a bit above and below for tiles that push reaches
+        for tile in world.tile_grid.query(self.rect.inflate(0, TILE_SIZE)):
             # Check for collision in x direction, collision between rectangles
-            if tile[1].colliderect(self.rect.x + delta_x, self.rect.y, self.get_width(), self.get_height()):
+            if tile.colliderect(self.rect.x + delta_x, self.rect.y, width, height):
                 delta_x = 0
                 can_move = False
 
             # Check for collision in y direction
-            if tile[1].colliderect(self.rect.x, self.rect.y + delta_y, self.get_width(), self.get_height()):
+            if tile.colliderect(self.rect.x, self.rect.y + delta_y, width, height):
                 # Swimming up
                 if self.vel_y < 0:
                     delta_y += 1
@@ -345,146 +1241,494 @@ class Player(Character):
 
         if keys[pygame.K_UP] and can_move:
             delta_y -= 2
-            self.image = pygame.transform.rotate(self.dive, 180)
+            self.image = self.swim_up
 
         if keys[pygame.K_RIGHT]:
             delta_x += 1
-            self.image = pygame.transform.rotate(self.dive, 90)
+            self.image = self.swim_right
 
         if keys[pygame.K_LEFT]:
             delta_x -= 1
-            self.image = pygame.transform.rotate(self.dive, 270)
+            self.image = self.swim_left
 
         # Update player coordinates
         self.rect.x += delta_x
         self.rect.y += delta_y
 
-    def collided(self, sprite_group):
-        # Collision with enemies, collision with sprites, if True delete sprite after collision
-        if pygame.sprite.spritecollide(self, sprite_group, False):
+    def collided(self, sprites):
+        # Collision with a group or the sprites of one kind from World.contacts()
+        if pygame.sprite.spritecollide(self, sprites, False):
             return True
 
-    def pick_up_flower(self, sprite_group):
-        keys = pygame.key.get_pressed()
-        if pygame.sprite.spritecollide(self, sprite_group, False):
-            if keys[pygame.K_DOWN]:
-                # Remove flower after its collected
-                pygame.sprite.spritecollide(self, sprite_group, True)
-                return True
+    def touching(self, rects):
+        # Collision with water or door tiles
+        return self.rect.collidelist(rects) != -1
+
+    def pick_up_flower(self, sprites, keys=None):
+        if keys is None:
+            keys = pygame.key.get_pressed()
+        flowers = pygame.sprite.spritecollide(self, sprites, False)
+        if flowers and keys[pygame.K_DOWN]:
+            # Remove flower after its collected
+            for flower in flowers:
+                flower.kill()
+            return True
 
-    def draw(self, window):
+    def draw(self, window, alpha=1, offset=(0, 0)):
         # Draw Character onto screen
-        super().draw(window)
+        rect = super().draw(window, alpha, offset)
 
         # Draw player box
         # Screen, color, target, line_width
         # pygame.draw.rect(window, (255, 255, 255), self.rect, 2)
+        return rect
 
     def health_bar(self, window, x, y):
-        pygame.draw.rect(window, (255, 0, 0), (x, y, 200, 15))
-        pygame.draw.rect(window, (0, 255, 0), (x, y, 200 * (self.health/self.max_health), 15))
-
-
-class Water(pygame.sprite.Sprite):
-    def __init__(self, x, y):
-        pygame.sprite.Sprite.__init__(self)
-        self.image = pygame.transform.scale(WATER[0], (TILE_SIZE, TILE_SIZE))
-        self.rect = self.image.get_rect()
-        self.rect.x = x
-        self.rect.y = y
-
-
-class DeepWater(pygame.sprite.Sprite):
-    def __init__(self, x, y):
-        pygame.sprite.Sprite.__init__(self)
-        self.image = pygame.transform.scale(WATER[1], (TILE_SIZE, TILE_SIZE))
-        self.rect = self.image.get_rect()
-        self.rect.x = x
-        self.rect.y = y
+        bar = window.fill((255, 0, 0), (x, y, 200, 15))
+        window.fill((0, 255, 0), (x, y, 200 * (self.health/self.max_health), 15))
+        return bar
+
+
+class TileGroup:
+    # Water and door tiles have no behavior, only a position and one of a few shared images.
+    # Positions are kept in flat x, y arrays, rects are only made for the tiles something asks for
+    def __init__(self, size=TILE_SIZE):
+        self.size = size
+        # Image -> x, y of every tile showing it, in the order they were added
+        self.tiles = {}
+
+    def __len__(self):
+        return sum(len(positions) for positions in self.tiles.values()) // 2
+
+    def __iter__(self):
+        size = self.size
+        return (pygame.Rect(positions[index], positions[index + 1], size, size)
+                for positions in self.tiles.values() for index in range(0, len(positions), 2))
+
+    def add(self, image, x, y):
+        positions = self.tiles.get(image)
+        if positions is None:
+            positions = self.tiles[image] = array.array('i')
+        positions.append(x)
+        positions.append(y)
+
+    def remove_area(self, area):
+        # Drop the tiles with their corner inside area, when its chunk unloads
+        for image, positions in self.tiles.items():
+            self.tiles[image] = array.array('i', [value for x, y in zip(positions[::2], positions[1::2])
+                                                  if not area.collidepoint(x, y) for value in (x, y)])
+
+    def empty(self):
+        self.tiles.clear()
+
+    def blits(self, offset=(0, 0)):
+        x, y = offset
+        size = self.size
+        return [(image, pygame.Rect(positions[index] - x, positions[index + 1] - y, size, size))
+                for image, positions in self.tiles.items() for index in range(0, len(positions), 2)]
+
+    def draw(self, surface, offset=(0, 0)):
+        return surface.blits(self.blits(offset))
+
+
+class StoreField:
+    # Sprite attribute kept in the EntityStore arrays while the sprite is in a store
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, sprite, owner=None):
+        if sprite is None:
+            return self
+        return sprite.store.column(self.name)[sprite.slot]
+
+    def __set__(self, sprite, value):
+        sprite.store.set(sprite.slot, self.name, value)
+
+
+class StoreRect(pygame.Rect):
+    # Rect of a sprite in an EntityStore, moving or resizing it moves or resizes the sprite.
+    # Rects made from it by move(), copy() and the like aren't tied to the sprite
+    __slots__ = ('sprite',)
+
+    def __init__(self, sprite):
+        store = sprite.store
+        super().__init__(store.column('x')[sprite.slot], store.column('y')[sprite.slot],
+                         store.column('width')[sprite.slot], store.column('height')[sprite.slot])
+        self.sprite = sprite
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name != 'sprite':
+            self.write()
+
+    def write(self):
+        sprite = getattr(self, 'sprite', None)
+        if sprite is not None:
+            sprite.rect = pygame.Rect(self)
+
+    def write_through(method):
+        def changed(rect, *args, **kwargs):
+            result = method(rect, *args, **kwargs)
+            rect.write()
+            return result
+        return changed
+
+    move_ip = write_through(pygame.Rect.move_ip)
+    inflate_ip = write_through(pygame.Rect.inflate_ip)
+    scale_by_ip = write_through(pygame.Rect.scale_by_ip)
+    clamp_ip = write_through(pygame.Rect.clamp_ip)
+    union_ip = write_through(pygame.Rect.union_ip)
+    unionall_ip = write_through(pygame.Rect.unionall_ip)
+    normalize = write_through(pygame.Rect.normalize)
+    update = write_through(pygame.Rect.update)
+    __setitem__ = write_through(pygame.Rect.__setitem__)
+    del write_through
+
+
+class EntityStore:
+    # Worms, flies and platforms as NumPy arrays, moved and animated a whole group at a time
+    VIEW_FIELDS = ('move_x', 'move_y', 'move_direction', 'move_counter', 'turning_point')
+    FIELDS = VIEW_FIELDS + ('x', 'y', 'width', 'height', 'previous_x', 'previous_y', 'cell_size')
+
+    def __init__(self, capacity=64):
+        self.arrays = {name: numpy.zeros(capacity, numpy.int32) for name in self.FIELDS}
+        # Row -> sprite and its image, animated sprites work out their frame when drawn
+        self.sprites = []
+        self.images = []
+        # Array columns as Python lists, made when first read after a change
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.sprites)
+
+    def column(self, name):
+        column = self.columns.get(name)
+        if column is None:
+            column = self.columns[name] = self.arrays[name][:len(self.sprites)].tolist()
+        return column
+
+    def set(self, slot, name, value):
+        self.arrays[name][slot] = value
+        self.columns.pop(name, None)
+
+    def rect(self, slot):
+        # A copy, moving it doesn't move the sprite
+        return pygame.Rect(self.column('x')[slot], self.column('y')[slot],
+                           self.column('width')[slot], self.column('height')[slot])
+
+    def set_rect(self, slot, rect):
+        for name, value in zip(('x', 'y', 'width', 'height'), rect):
+            self.set(slot, name, value)
+
+    def add(self, sprite):
+        slot = len(self.sprites)
+        if slot == len(self.arrays['x']):
+            for name, values in self.arrays.items():
+                self.arrays[name] = numpy.concatenate((values, numpy.zeros_like(values)))
+        rect = sprite.rect
+        values = {name: getattr(sprite, name) for name in self.VIEW_FIELDS}
+        values.update(x=rect.x, y=rect.y, width=rect.width, height=rect.height,
+                      previous_x=sprite.previous[0], previous_y=sprite.previous[1],
+                      cell_size=sprite.grid.cell_size if sprite.grid is not None else 0)
+        for name in self.FIELDS:
+            self.arrays[name][slot] = values[name]
+        self.sprites.append(sprite)
+        self.images.append(sprite._image)
+        # From here on the sprite's attributes are read from and written to its row
+        sprite.__class__ = type(sprite).stored_class()
+        sprite.store = self
+        sprite.slot = slot
+        self.columns.clear()
+
+    def remove(self, sprite):
+        # Hand the sprite its state back and fill the hole with the last row
+        slot = sprite.slot
+        sprite.__class__ = sprite.entity_class
+        for name in self.VIEW_FIELDS:
+            setattr(sprite, name, self.column(name)[slot])
+        sprite.move_x = bool(sprite.move_x)
+        sprite.move_y = bool(sprite.move_y)
+        sprite.rect = self.rect(slot)
+        sprite.image = self.images[slot]
+        sprite.previous = (self.column('previous_x')[slot], self.column('previous_y')[slot])
+        sprite.store = None
+        sprite.slot = None
+
+        last = len(self.sprites) - 1
+        if slot != last:
+            for values in self.arrays.values():
+                values[slot] = values[last]
+            moved = self.sprites[last]
+            moved.slot = slot
+            self.sprites[slot] = moved
+            self.images[slot] = self.images[last]
+        self.sprites.pop()
+        self.images.pop()
+        self.columns.clear()
 
+    def update(self):
+        # Same steps as Worm.update, Fly.update and Platform.update, for every row at once
+        count = len(self.sprites)
+        if not count:
+            return
+        arrays = {name: values[:count] for name, values in self.arrays.items()}
+        x, y = arrays['x'], arrays['y']
+        previous_x, previous_y = arrays['previous_x'], arrays['previous_y']
+        direction = arrays['move_direction']
+        move_counter = arrays['move_counter']
+        previous_x[:] = x
+        previous_y[:] = y
+        x += direction * arrays['move_x']
+        y += direction * arrays['move_y']
+        move_counter += 1
 
-class Worm(pygame.sprite.Sprite):
-    def __init__(self, x, y):
-        pygame.sprite.Sprite.__init__(self)
-        # Images
-        self.worm_right = []
-        self.worm_left = []
-        worm_list = random.choice(WORM)
-        for n in range(2):
-            image = pygame.transform.scale(worm_list[n], (TILE_SIZE - 20, TILE_SIZE - 20))
-            self.worm_left.append(image)
-            image = pygame.transform.flip(image, True, False)
-            self.worm_right.append(image)
-        self.image = self.worm_right[0]
-        self.rect = self.image.get_rect()
+        # Change direction
+        turning = move_counter > arrays['turning_point']
+        direction[turning] *= -1
+        move_counter[turning] *= -1
+        self.columns.clear()
+
+        # Keep collision grids up to date for rows that crossed into other cells
+        cell_size = arrays['cell_size']
+        if cell_size.any():
+            size = numpy.maximum(cell_size, 1)
+            width, height = arrays['width'], arrays['height']
+            crossed = ((previous_x // size != x // size) | ((previous_x + width - 1) // size != (x + width - 1) // size) |
+                       (previous_y // size != y // size) | ((previous_y + height - 1) // size != (y + height - 1) // size))
+            for slot in numpy.flatnonzero(crossed & (cell_size > 0)).tolist():
+                sprite = self.sprites[slot]
+                sprite.grid.move(sprite, self.rect(slot))
+
+    def blits(self, alpha, offset=(0, 0)):
+        # Images and screen positions between the last two ticks, like interpolate()
+        count = len(self.sprites)
+        positions = []
+        for axis, previous, shift in (('x', 'previous_x', offset[0]), ('y', 'previous_y', offset[1])):
+            start = self.arrays[previous][:count]
+            positions.append((numpy.round(start + (self.arrays[axis][:count] - start) * alpha) - shift).astype(int).tolist())
+        # Animation frames are only picked here, for the sprites being drawn
+        direction = self.column('move_direction')
+        images = [image if sprite.animation is None else sprite.animation.frame(direction[slot])
+                  for slot, (sprite, image) in enumerate(zip(self.sprites, self.images))]
+        return list(zip(images, zip(*positions)))
+
+
+class SlottedSprite:
+    # pygame.sprite.Sprite without an instance dict. Groups take objects that aren't Sprites
+    # through the same methods, so it goes in any pygame group. A sprite is in one or two groups,
+    # so they are kept in a list
+    __slots__ = ('in_groups',)
+
+    def __init__(self, *groups):
+        self.in_groups = []
+        self.add(*groups)
+
+    def add(self, *groups):
+        for group in groups:
+            if group not in self.in_groups:
+                group.add_internal(self)
+                self.add_internal(group)
+
+    def remove(self, *groups):
+        for group in groups:
+            if group in self.in_groups:
+                group.remove_internal(self)
+                self.remove_internal(group)
+
+    def add_internal(self, group):
+        self.in_groups.append(group)
+
+    def remove_internal(self, group):
+        self.in_groups.remove(group)
+
+    def update(self, *args, **kwargs):
+        pass
+
+    def kill(self):
+        for group in self.in_groups:
+            group.remove_internal(self)
+        self.in_groups.clear()
+
+    def groups(self):
+        return list(self.in_groups)
+
+    def alive(self):
+        return bool(self.in_groups)
+
+
+class EntityGroup(pygame.sprite.Group):
+    # Sprite group that keeps its sprites in an EntityStore when ENTITY_STORE is on
+    def __init__(self, *sprites):
+        self.store = EntityStore() if ENTITY_STORE and numpy is not None else None
+        super().__init__(*sprites)
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+        if self.store is not None:
+            self.store.add(sprite)
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        if self.store is not None:
+            self.store.remove(sprite)
+
+    def update(self, *args, **kwargs):
+        if self.store is None:
+            super().update(*args, **kwargs)
+        else:
+            self.store.update()
+
+    def use_store(self, store):
+        # Move the sprites to another store, groups sharing one are all moved by a single store.update()
+        for sprite in self.sprites():
+            if self.store is not None:
+                self.store.remove(sprite)
+            store.add(sprite)
+        self.store = store
+
+
+class Entity(SlottedSprite):
+    # Worm, fly or platform, moved one at a time by its update().
+    # In an EntityStore it becomes a StoredEntity, a view on its row of the store's arrays
+    __slots__ = ('store', 'slot', 'grid', 'animation', 'rect', 'previous', 'move_x', 'move_y', 'move_direction',
+                 'move_counter', 'turning_point', '_image')
+
+    def __init__(self):
+        SlottedSprite.__init__(self)
+        self.store = None
+        self.slot = None
+        self.grid = None
+        # Worms and flies show a frame of their animation, platforms their one image
+        self.animation = None
+        self._image = None
+
+    @property
+    def image(self):
+        if self.animation is not None:
+            return self.animation.frame(self.move_direction)
+        return self._image
+
+    @image.setter
+    def image(self, image):
+        self._image = image
+
+    @classmethod
+    def stored_class(cls):
+        # The class sprites of this class take while they are in a store, made on first use
+        stored = cls.__dict__.get('stored')
+        if stored is None:
+            stored = type(f'Stored{cls.__name__}', (StoredEntity, cls), {'__slots__': (), 'entity_class': cls})
+            cls.stored = stored
+        return stored
+
+
+class StoredEntity(Entity):
+    __slots__ = ()
+    move_x = StoreField()
+    move_y = StoreField()
+    move_direction = StoreField()
+    move_counter = StoreField()
+    turning_point = StoreField()
+
+    @property
+    def rect(self):
+        return StoreRect(self)
+
+    @rect.setter
+    def rect(self, rect):
+        self.store.set_rect(self.slot, rect)
+
+    @property
+    def previous(self):
+        return self.store.column('previous_x')[self.slot], self.store.column('previous_y')[self.slot]
+
+    @previous.setter
+    def previous(self, previous):
+        self.store.set(self.slot, 'previous_x', previous[0])
+        self.store.set(self.slot, 'previous_y', previous[1])
+
+    @property
+    def image(self):
+        if self.animation is not None:
+            return self.animation.frame(self.move_direction)
+        return self.store.images[self.slot]
+
+    @image.setter
+    def image(self, image):
+        self.store.images[self.slot] = image
+
+
+class Worm(Entity):
+    __slots__ = ()
+
+    def __init__(self, x, y, rng=random, grid=None, clock=None):
+        super().__init__()
+        # Frames shared with every worm of the same look, played by the world's clock
+        worm_list = rng.choice(WORM)
+        table = ASSETS.animation(worm_list[:2], ENEMY_SIZE, ENEMY_FRAME_TIME)
+        self.animation = Animation(Clock() if clock is None else clock, table)
+        self.rect = table.right[0].get_rect()
 
         # Settings
         self.rect.x = x
         self.rect.y = y
         self.move_direction = 1
         self.move_counter = 0
-        self.index = 0
-        self.counter = 0
         self.turning_point = 50
-        self.animation_delay = 10
+        self.move_x = True
+        self.move_y = False
+        self.previous = self.rect.topleft
+
+        # Keep collision grid up to date while moving, the world inserts it when its chunk loads
+        self.grid = grid
 
     def update(self):
+        self.previous = self.rect.topleft
         self.rect.x += self.move_direction
+        if self.grid is not None:
+            self.grid.move(self, self.rect)
         self.move_counter += 1
-        self.counter += 1
 
         # Change direction
         if abs(self.move_counter > self.turning_point):
             self.move_direction *= -1
             self.move_counter *= -1
 
-        # Animation
-        if self.counter > self.animation_delay:
-            self.counter = 0
-            self.index += 1
-            if self.index >= len(self.worm_left):
-                self.index = 0
-            if self.move_direction == 1:
-                self.image = self.worm_right[self.index]
-            if self.move_direction == -1:
-                self.image = self.worm_left[self.index]
-
-
-class Fly(pygame.sprite.Sprite):
-    def __init__(self, x, y, move_x, move_y):
-        pygame.sprite.Sprite.__init__(self)
-        # Images
-        self.fly_right = []
-        self.fly_left = []
-        fly_list = random.choice(FLY)
-        for n in range(2):
-            image = pygame.transform.scale(fly_list[n], (TILE_SIZE - 20, TILE_SIZE - 20))
-            self.fly_left.append(image)
-            image = pygame.transform.flip(image, True, False)
-            self.fly_right.append(image)
-        self.image = self.fly_right[0]
-        self.rect = self.image.get_rect()
+
+class Fly(Entity):
+    __slots__ = ()
+
+    def __init__(self, x, y, move_x, move_y, rng=random, grid=None, clock=None):
+        super().__init__()
+        # Frames shared with every fly of the same look, played by the world's clock
+        fly_list = rng.choice(FLY)
+        table = ASSETS.animation(fly_list[:2], ENEMY_SIZE, ENEMY_FRAME_TIME)
+        self.animation = Animation(Clock() if clock is None else clock, table)
+        self.rect = table.right[0].get_rect()
 
         # Settings
         self.rect.x = x
         self.rect.y = y
         self.move_direction = 1
         self.move_counter = 0
-        self.index = 0
-        self.counter = 0
         self.turning_point = 50
-        self.animation_delay = 10
         self.move_x = move_x
         self.move_y = move_y
+        self.previous = self.rect.topleft
+
+        # Keep collision grid up to date while moving, the world inserts it when its chunk loads
+        self.grid = grid
 
     def update(self):
+        self.previous = self.rect.topleft
         self.move_counter += 1
-        self.counter += 1
 
         if self.move_x:
             self.rect.x += self.move_direction
         if self.move_y:
             self.rect.y += self.move_direction
+        if self.grid is not None:
+            self.grid.move(self, self.rect)
 
         # Change direction
         if abs(self.move_counter > self.turning_point):
@@ -492,30 +1736,23 @@ class Fly(pygame.sprite.Sprite):
             self.move_direction *= -1
             self.move_counter *= -1
 
-        # Animation
-        if self.counter > self.animation_delay:
-            self.counter = 0
-            self.index += 1
-            if self.index >= len(self.fly_left):
-                self.index = 0
-            if self.move_direction == 1:
-                self.image = self.fly_right[self.index]
-            if self.move_direction == -1:
-                self.image = self.fly_left[self.index]
-
-
-class Flower(pygame.sprite.Sprite):
-    def __init__(self, x, y):
-        pygame.sprite.Sprite.__init__(self)
-        self.image = pygame.transform.scale(random.choice(FLOWER), (TILE_SIZE // 3, TILE_SIZE // 3))
+
+class Flower(SlottedSprite):
+    __slots__ = ('image', 'rect')
+
+    def __init__(self, x, y, rng=random):
+        SlottedSprite.__init__(self)
+        self.image = ASSETS.get(rng.choice(FLOWER), FLOWER_SIZE)
         self.rect = self.image.get_rect()
         self.rect.center = (x, y)
 
 
-class Platform(pygame.sprite.Sprite):
-    def __init__(self, x, y, move_x, move_y):
-        pygame.sprite.Sprite.__init__(self)
-        self.image = pygame.transform.scale(PLATFORM, (TILE_SIZE, TILE_SIZE // 2))
+class Platform(Entity):
+    __slots__ = ()
+
+    def __init__(self, x, y, move_x, move_y, grid=None):
+        super().__init__()
+        self.image = ASSETS.get(PLATFORM, PLATFORM_SIZE)
         self.rect = self.image.get_rect()
         self.rect.x = x
         self.rect.y = y
@@ -524,13 +1761,20 @@ class Platform(pygame.sprite.Sprite):
         self.turning_point = 50
         self.move_x = move_x
         self.move_y = move_y
+        self.previous = self.rect.topleft
+
+        # Keep collision grid up to date while moving, the world inserts it when its chunk loads
+        self.grid = grid
 
     def update(self):
+        self.previous = self.rect.topleft
         self.move_counter += 1
         if self.move_x:
             self.rect.x += self.move_direction
         if self.move_y:
             self.rect.y += self.move_direction
+        if self.grid is not None:
+            self.grid.move(self, self.rect)
 
         # Change direction
         if abs(self.move_counter > self.turning_point):
@@ -538,15 +1782,6 @@ class Platform(pygame.sprite.Sprite):
             self.move_counter *= -1
 
 
-class Door(pygame.sprite.Sprite):
-    def __init__(self, x, y):
-        pygame.sprite.Sprite.__init__(self)
-        self.image = pygame.transform.scale(DOOR, (TILE_SIZE, TILE_SIZE))
-        self.rect = self.image.get_rect()
-        self.rect.x = x
-        self.rect.y = y
-
-
 class Button:
     def __init__(self, x, y, image):
         self.image = image
@@ -574,220 +1809,874 @@ class Button:
         return action
 
 
-# Game is on
-def platform_game():
-    level = 1
-    max_levels = 10
-    health = 1
-
-    def load_level():
-        # Load level data
-        pickle_in = open(f'levels/level{level}', 'rb')
-        world_data = pickle.load(pickle_in)
-        return world_data
-
-    player_controls = True
-    player_dead = False
-    score = 0
-    restart = False
-    finish = False
-    finish_btn = False
-    starting_pos = [100, HEIGHT - 50]
-
-    clock = pygame.time.Clock()
-
-    world = World(load_level())
-
-    player = Player(starting_pos[0], starting_pos[1], health=health)
-
-    restart_btn = Button(WIDTH // 2 - RESTART.get_width() // 2, HEIGHT // 2 + 100, RESTART)
-
-    score_flower = Flower(WIDTH - 126, TILE_SIZE + 15)
-    world.flower_group.add(score_flower)
-
-    def refresh_window():
-        # Draw images to the screen
-        WIN.blit(BG, (0, 0))
-        WIN.blit(SUN, (480, 110))
-
-        # Draw world
-        world.draw(WIN)
-
-        # Draw sprites
-        world.water_group.draw(WIN)
-        world.under_water_group.draw(WIN)
-        world.worm_group.draw(WIN)
-        world.worm_group.update()
-        world.fly_group.draw(WIN)
-        world.fly_group.update()
-        world.flower_group.draw(WIN)
-        world.platform_group.draw(WIN)
-        world.platform_group.update()
-        world.door_group.draw(WIN)
-
-        # Draw player
-        player.draw(WIN)
-
-        # Draw gridlines
-        # grid_lines()
+class TextureWindow:
+    # Stands in for the display surface, blits become texture copies through an SDL renderer.
+    # Surfaces are uploaded the first time they are drawn and must not change afterwards
+    def __init__(self, title, size, accelerated=True):
+        # SDL won't put a renderer on the window pygame.display draws to, that one stays hidden
+        # and images are still converted to its pixel format
+        pygame.display.set_mode(size, pygame.HIDDEN)
+        self.window = sdl2_video.Window(title, size)
+        self.accelerated = accelerated
+        try:
+            self.renderer = sdl2_video.Renderer(self.window, accelerated=1 if accelerated else 0)
+        except sdl2_video.error:
+            # No GPU, SDL's software renderer still batches the copies
+            self.renderer = sdl2_video.Renderer(self.window, accelerated=0)
+            self.accelerated = False
+        self.rect = pygame.Rect((0, 0), size)
+        # Surface -> its texture, let go of with the surface
+        self.textures = weakref.WeakKeyDictionary()
+        self.uploads = 0
+
+    def get_size(self):
+        return self.rect.size
 
-        # Level text
-        level_label = SCORE_FONT.render(f'LEVEL {level}', True, BLACK)
-        WIN.blit(level_label, (WIDTH//2 + 83, 52))
-
-        # Score text
-        score_label = SCORE_FONT.render(f'X {score}', True, BLACK)
-        WIN.blit(score_label, (WIDTH - 110, 52))
-
-        # Health bar
-        health_label = SCORE_FONT.render('HEALTH', True, BLACK)
-        WIN.blit(health_label, (63, 52))
-        player.health_bar(WIN, 154, 58)
-
-        # Finish game
-        if finish_btn:
-            finish_label = FINISH_FONT.render('Congratulations! You finished the game.', True, ORANGE)
-            WIN.blit(finish_label, (WIDTH // 2 - finish_label.get_width() // 2, HEIGHT // 2))
-            if restart_btn.draw(WIN):
-                platform_game()
+    def get_width(self):
+        return self.rect.width
 
-        # Restart game
-        if restart:
-            game_over_label = RESTART_FONT.render('Game Over', True, ORANGE)
-            WIN.blit(game_over_label, (WIDTH // 2 - game_over_label.get_width() // 2, HEIGHT // 2))
-            if restart_btn.draw(WIN):
-                platform_game()
+    def get_height(self):
+        return self.rect.height
+
+    def get_rect(self):
+        return self.rect.copy()
+
+    def texture(self, surface):
+        texture = self.textures.get(surface)
+        if texture is None:
+            texture = self.textures[surface] = sdl2_video.Texture.from_surface(self.renderer, surface)
+            self.uploads += 1
+        return texture
+
+    def blit(self, source, dest, area=None):
+        # Same arguments and returned rect as Surface.blit
+        area = source.get_rect() if area is None else pygame.Rect(area)
+        rect = pygame.Rect(dest[0], dest[1], area.width, area.height)
+        self.texture(source).draw(area, rect)
+        return rect.clip(self.rect)
+
+    def blits(self, blit_sequence):
+        return [self.blit(*blit) for blit in blit_sequence]
+
+    def fill(self, color, rect=None):
+        self.renderer.draw_color = pygame.Color(color)
+        if rect is None:
+            self.renderer.clear()
+            return self.rect.copy()
+        rect = pygame.Rect(rect)
+        # SDL still draws a line for an empty rect, Surface.fill draws nothing
+        if rect.width > 0 and rect.height > 0:
+            self.renderer.fill_rect(rect)
+        return rect.clip(self.rect)
+
+    def present(self):
+        self.renderer.present()
+
+
+def merge_rects(rects):
+    # Overlapping rects joined into their bounding boxes until none overlap, so nothing is drawn twice
+    merged = []
+    for rect in rects:
+        if not rect.width or not rect.height:
+            continue
+        rect = rect.copy()
+        index = rect.collidelist(merged)
+        while index != -1:
+            rect.union_ip(merged.pop(index))
+            index = rect.collidelist(merged)
+        merged.append(rect)
+    return merged
+
+
+class Renderer:
+    def __init__(self, dirty=True):
+        self.dirty = dirty
+        self.background = None
+        self.static_state = None
+        # Screen areas drawn this frame and the frame before
+        self.rects = []
+        self.last_rects = []
+        # Areas put back to the background this frame, everything in them is drawn again
+        self.cleared = []
+
+    def draw_background(self, surface, world, offset=(0, 0)):
+        # Everything that doesn't move and is under the enemies.
+        # Flowers and doors are drawn over worms and flies, so they are drawn in the cleared areas every frame
+        surface.blit(ASSETS.get(BG), (0, 0))
+        surface.blit(ASSETS.get(SUN), (480, 110))
+        world.draw(surface, offset)
+        for group in (world.water_group, world.under_water_group):
+            surface.blits(self.blits(group, None, offset))
+
+    def bake(self, world, offset=(0, 0)):
+        # The background in one surface, put back behind sprites while nothing under them changes
+        background = pygame.Surface((WIDTH, HEIGHT)).convert()
+        self.draw_background(background, world, offset)
+        return background
+
+    def restore(self, window, world, offset=(0, 0), rects=()):
+        # Put the background back where sprites were drawn last frame and where they are about to be drawn.
+        # When the level changes, the camera scrolls, chunks stream in or out, a flower is picked
+        # or the door goes away, the whole background is drawn again instead. Baking it then would be
+        # thrown away the next frame while the camera keeps moving, so it waits for a frame that keeps it
+        static_state = (world, world.version, offset, len(world.flower_group), len(world.door_group))
+        screen = window.get_rect()
+        if static_state != self.static_state:
+            self.static_state = static_state
+            self.background = None
+            self.draw_background(window, world, offset)
+            self.cleared = [screen]
+            return
+        if self.background is None:
+            self.background = self.bake(world, offset)
+        self.cleared = merge_rects([rect.clip(screen) for rect in self.last_rects + list(rects)])
+        for rect in self.cleared:
+            window.blit(self.background, rect, rect)
+
+    def blits(self, group, alpha=1, offset=(0, 0)):
+        # Images and screen positions, sprites that don't move are drawn where they are, without alpha
+        x, y = offset
+        if isinstance(group, TileGroup):
+            return group.blits(offset)
+        if alpha is None:
+            return [(sprite.image, sprite.rect.move(-x, -y)) for sprite in group]
+        if isinstance(group, EntityGroup) and group.store is not None:
+            return group.store.blits(alpha, offset)
+        return [(sprite.image, (sprite_x - x, sprite_y - y))
+                for sprite, (sprite_x, sprite_y) in ((sprite, interpolate(sprite, alpha)) for sprite in group)]
+
+    def draw_blits(self, window, blits):
+        for rect in window.blits(blits):
+            self.mark(rect)
+
+    def draw_group(self, window, group, alpha=1, offset=(0, 0)):
+        self.draw_blits(window, self.blits(group, alpha, offset))
+
+    def draw_static(self, window, group, offset=(0, 0)):
+        # Flowers and doors inside the cleared areas only, outside them they are still on the screen
+        for image, rect in self.blits(group, None, offset):
+            for area in self.cleared:
+                if rect.colliderect(area):
+                    clip = rect.clip(area)
+                    window.blit(image, clip, clip.move(-rect.x, -rect.y))
+
+    def mark(self, rect):
+        # Skip sprites that are off the screen
+        if self.dirty and rect.width and rect.height:
+            self.rects.append(rect)
 
-        # Update window
-        pygame.display.update()
+    def update(self):
+        if not self.dirty:
+            present()
+            return
+        present(self.cleared + self.rects)
+        self.last_rects = self.rects
+        self.rects = []
+        self.cleared = []
+
+
+class FrameProfiler:
+    # Time spent in each part of the game loop, in milliseconds per frame
+    SECTIONS = ('sprites', 'player', 'world', 'hud', 'flip')
+
+    def __init__(self, history=300):
+        self.history = {name: collections.deque(maxlen=history) for name in self.SECTIONS + ('frame',)}
+        self.times = dict.fromkeys(self.SECTIONS, 0.0)
+        self.last = time.perf_counter()
+        self.frames = 0
+        self.visible = False
+        self.overlay = None
+        self.export = None
+        self.writer = None
+
+    def export_to(self, path):
+        # Every frame goes to a CSV file, or JSON lines if the name ends with .jsonl
+        self.export = open(path, 'w', newline='')
+        if not path.endswith('.jsonl'):
+            self.writer = csv.writer(self.export)
+            self.writer.writerow(('frame',) + self.SECTIONS + ('total',))
+
+    def start(self):
+        self.last = time.perf_counter()
+
+    def lap(self, name):
+        # Time since the last lap goes to this section
+        now = time.perf_counter()
+        self.times[name] += (now - self.last) * 1000
+        self.last = now
+
+    def end_frame(self):
+        total = sum(self.times.values())
+        for name, value in self.times.items():
+            self.history[name].append(value)
+        self.history['frame'].append(total)
+        if self.writer is not None:
+            self.writer.writerow([self.frames] + [f'{self.times[name]:.4f}' for name in self.SECTIONS] + [f'{total:.4f}'])
+        elif self.export is not None:
+            self.export.write(json.dumps(dict(frame=self.frames, total=total, **self.times)) + '\n')
+        self.times = dict.fromkeys(self.SECTIONS, 0.0)
+        self.frames += 1
+
+    def percentiles(self, name):
+        values = sorted(self.history[name])
+        if not values:
+            return 0.0, 0.0, 0.0
+        return tuple(values[min(len(values) - 1, int(len(values) * p))] for p in (0.5, 0.95, 0.99))
 
-    while True:
-        clock.tick(FPS)
-        refresh_window()
+    def draw(self, window):
+        if not self.visible:
+            return None
+
+        # Rebuild the overlay twice a second, not every frame
+        if self.overlay is None or self.frames % 30 == 0:
+            lines = ['ms        p50     p95     p99']
+            for name in self.SECTIONS + ('frame',):
+                lines.append(f'{name:<8}' + ''.join(f'{value:>8.2f}' for value in self.percentiles(name)))
+            audio = AUDIO.metrics()
+            lines.append(f'sound   {audio["voices"]}/{audio["peak_voices"]} voices, {audio["dropped"]} dropped, '
+                         f'{audio["stolen"]} stolen, {audio["p95_play_ms"]:.2f} ms p95')
+            labels = [TEXT_CACHE.font(PROFILER_FONT).render(line, True, WHITE) for line in lines]
+            self.overlay = pygame.Surface((max(label.get_width() for label in labels) + 10,
+                                           sum(label.get_height() for label in labels) + 10))
+            self.overlay.set_alpha(200)
+            y = 5
+            for label in labels:
+                self.overlay.blit(label, (5, y))
+                y += label.get_height()
+        return window.blit(self.overlay, (10, HEIGHT - self.overlay.get_height() - 10))
+
+    def close(self):
+        if self.export is not None:
+            self.export.close()
+            self.export = None
+            self.writer = None
+
+
+PROFILER = FrameProfiler()
+
+
+def build_world(level, seed, data):
+    return finish_world(*make_world(level, seed, data))
+
+
+def make_world(level, seed, data):
+    # The part of a world that needs no images, safe to make on the loader thread.
+    # Enemy and flower looks come from the seed, so a replay builds the same levels
+    rng = random.Random(f'{seed}:{level}')
+    return World(data, rng), rng
+
+
+def finish_world(world, rng):
+    # Sprites, tile images and baked layers, only made on the main thread: SDL surfaces and the
+    # shared ASSETS cache aren't safe to use from two threads at once.
+    # Flower next to the score, drawn with the HUD
+    world.score_flower = Flower(WIDTH - 126, TILE_SIZE + 15, rng)
+    # Load the chunks around the start, so the first frame has them
+    camera = Camera(world.bounds)
+    camera.snap(pygame.Rect(START_POS, (TILE_SIZE, TILE_SIZE)))
+    world.stream(camera.view)
+    return world
+
+
+class LevelLoader:
+    # Reads levels and starts the next world on a worker thread while the current one is played
+    def __init__(self, cache_size=4):
+        # Level number -> Level, least recently used first
+        self.levels = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.executor = None
+        # (level number, seed) and the world being built for it
+        self.pending = None
+
+    def level(self, number):
+        with self.lock:
+            data = self.levels.get(number)
+            if data is not None:
+                self.levels.move_to_end(number)
+                return data
+        data = Level.load(f'levels/level{number}.lvl')
+        with self.lock:
+            self.levels[number] = data
+            if len(self.levels) > self.cache_size:
+                self.levels.popitem(last=False)
+        return data
+
+    def build(self, number, seed):
+        return build_world(number, seed, self.level(number))
+
+    def make(self, number, seed):
+        return make_world(number, seed, self.level(number))
+
+    def prefetch(self, number, seed):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='level-loader')
+        if self.pending is not None:
+            self.pending[1].cancel()
+        self.pending = ((number, seed), self.executor.submit(self.make, number, seed))
+
+    def world(self, number, seed):
+        # Swap in the prefetched world if it is the one we want and finish it here, otherwise build it now
+        if self.pending is not None and self.pending[0] == (number, seed):
+            future = self.pending[1]
+            self.pending = None
+            return finish_world(*future.result())
+        return self.build(number, seed)
+
+
+LEVELS = LevelLoader()
+
+
+class Game:
+    def __init__(self, level=1, max_levels=10, health=1, seed=None, prefetch=True):
+        self.level = level
+        self.seed = random.randrange(2 ** 32) if seed is None else seed
+        self.prefetch = prefetch
+        self.max_levels = max_levels
+        self.player_controls = True
+        self.player_dead = False
+        self.score = 0
+        self.restart = False
+        self.finish = False
+        self.finish_btn = False
+        self.starting_pos = list(START_POS)
+        self.ticks = 0
+        self.world = self.load_world()
+        self.player = Player(self.starting_pos[0], self.starting_pos[1], health=health)
+        self.camera = None
+        self.start_camera()
+
+    def load_world(self):
+        world = LEVELS.world(self.level, self.seed)
+        # Start on the next level while this one is played
+        if self.prefetch and self.level < self.max_levels:
+            LEVELS.prefetch(self.level + 1, self.seed)
+        return world
+
+    def start_camera(self):
+        # New level, look at the player straight away
+        self.camera = Camera(self.world.bounds)
+        self.camera.snap(self.player.rect)
+        self.world.stream(self.camera.view)
+
+    def update(self, keys=None):
+        # One simulation tick, keys default to the real keyboard
+        if keys is None:
+            keys = pygame.key.get_pressed()
+        self.update_sprites()
+        self.update_player(keys)
+
+    def update_sprites(self):
+        # Move enemies and platforms
+        self.world.clock.tick()
+        self.world.worm_group.update()
+        self.world.fly_group.update()
+        self.world.platform_group.update()
+
+    def update_player(self, keys):
+        world = self.world
+        player = self.player
+        self.ticks += 1
+        player.clock.tick()
+
+        # Remember where the player was for drawing between ticks
+        player.previous = player.rect.topleft
 
         # Give control to the player
-        if player_controls:
-            player.controls(world)
+        if self.player_controls:
+            player.controls(world, keys)
+
+        # Everything the player can touch for the rest of the tick, swimming moves it a few pixels at most
+        contacts = world.contacts(player.rect.inflate(TILE_SIZE, TILE_SIZE))
 
         # Check if player goes swimming
-        if player.collided(world.water_group):
+        if player.touching(contacts['water']):
             player.rect.y += 1
-            player_controls = False
+            self.player_controls = False
             # Change controls to swimming settings
-            player.swim(world)
+            player.swim(world, keys)
             # If player goes off water, change controls back to normal
-            if not player.collided(world.water_group):
-                player_controls = True
+            if not player.touching(contacts['water']):
+                self.player_controls = True
             # If player goes too deep in water
-            if player.collided(world.under_water_group):
+            if player.touching(contacts['under_water']):
                 player.health -= 1
                 if player.health == 0:
-                    player_dead = True
+                    self.player_dead = True
                     GAME_OVER_FX.play()
                 elif player.health > player.max_health:
                     player.health = player.max_health
 
         # Player collided with enemies
-        if player.collided(world.worm_group) or player.collided(world.fly_group):
+        if player.collided(contacts['worm']) or player.collided(contacts['fly']):
             player.health -= 1
             if player.health == 0:
-                player_dead = True
+                self.player_dead = True
                 GAME_OVER_FX.play()
             elif player.health > player.max_health:
                 player.health = player.max_health
 
         # Pick up those flowers
-        if player.pick_up_flower(world.flower_group):
-            score += 1
+        if player.pick_up_flower(contacts['flower'], keys):
+            self.score += 1
             player.health += 10
             SCORE_FX.play()
             if player.health > 100:
                 player.health = 100
 
         # Go to next level
-        if player.collided(world.door_group):
-            if level == max_levels:
-                finish = True
+        if player.touching(contacts['door']):
+            if self.level == self.max_levels:
+                self.finish = True
             else:
-                level += 1
-                world = World(load_level())
-                player.rect.x = starting_pos[0]
-                player.rect.y = starting_pos[1]
-                score_flower = Flower(WIDTH - 126, TILE_SIZE + 15)
-                world.flower_group.add(score_flower)
+                self.level += 1
+                self.world = self.load_world()
+                player.rect.x = self.starting_pos[0]
+                player.rect.y = self.starting_pos[1]
+                player.previous = player.rect.topleft
+                self.start_camera()
 
         # It's over
-        if player_dead:
-            player_controls = False
-            restart = True
+        if self.player_dead:
+            self.player_controls = False
+            self.restart = True
             player.image = player.angel
-            if player.rect.y > 80:
+            if player.rect.y > self.camera.offset[1] + 80:
                 player.rect.y -= 2
 
         # Congratulations
-        if finish:
-            world.door_group.empty()
-            player_controls = False
-            finish_btn = True
+        if self.finish:
+            self.world.remove_doors()
+            self.player_controls = False
+            self.finish_btn = True
+
+        # Scroll after the player, the camera stays put while the angel flies up
+        if self.player_dead:
+            self.camera.previous = self.camera.offset
+        else:
+            self.camera.follow(player.rect)
+        self.world.stream(self.camera.view)
+
+
+class KeyState:
+    # Arrow keys for one tick, indexed like pygame.key.get_pressed()
+    KEYS = (pygame.K_LEFT, pygame.K_RIGHT, pygame.K_UP, pygame.K_DOWN)
+
+    def __init__(self, left=False, right=False, up=False, down=False):
+        self.keys = {pygame.K_LEFT: left, pygame.K_RIGHT: right, pygame.K_UP: up, pygame.K_DOWN: down}
+
+    def __getitem__(self, key):
+        return self.keys.get(key, False)
+
+    @classmethod
+    def from_pressed(cls, pressed):
+        return cls(*(bool(pressed[key]) for key in cls.KEYS))
+
+    @classmethod
+    def from_bits(cls, bits):
+        return cls(*(bool(bits & 1 << n) for n in range(len(cls.KEYS))))
+
+    def bits(self):
+        # Left, right, up and down as the low four bits of one byte
+        return sum(1 << n for n, key in enumerate(self.KEYS) if self.keys[key])
+
+
+class Recording:
+    # Input log of one game: header, then one byte of key bits per tick, zlib compressed
+    MAGIC = b'PLRP'
+    VERSION = 1
+    HEADER = struct.Struct('<4sBHQI')
+
+    def __init__(self, level, seed, inputs=b''):
+        self.level = level
+        self.seed = seed
+        self.inputs = bytearray(inputs)
+
+    def record(self, keys):
+        self.inputs.append(keys.bits())
+
+    def key_states(self):
+        return (KeyState.from_bits(bits) for bits in self.inputs)
+
+    def save(self, path):
+        with open(path, 'wb') as recording_out:
+            recording_out.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.level, self.seed, len(self.inputs)))
+            recording_out.write(zlib.compress(bytes(self.inputs)))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as recording_in:
+            header = recording_in.read(cls.HEADER.size)
+            if len(header) != cls.HEADER.size:
+                raise ValueError(f'{path} is too short for a recording')
+            magic, version, level, seed, ticks = cls.HEADER.unpack(header)
+            if magic != cls.MAGIC or version != cls.VERSION:
+                raise ValueError(f'{path} is not a version {cls.VERSION} recording')
+            try:
+                inputs = zlib.decompress(recording_in.read())
+            except zlib.error as error:
+                raise ValueError(f'{path} has corrupt inputs: {error}') from None
+        if len(inputs) != ticks:
+            raise ValueError(f'{path} should have {ticks} ticks, found {len(inputs)}')
+        return cls(level, seed, inputs)
+
+
+def random_inputs(rng, hold=15):
+    # Endless random key presses, each held for a few ticks
+    while True:
+        keys = KeyState(rng.random() < 0.3, rng.random() < 0.5, rng.random() < 0.3, rng.random() < 0.2)
+        for _ in range(hold):
+            yield keys
 
-        # Close window
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
 
+def run_headless(inputs, level=1, max_ticks=None, seed=None, stop_at_door=True):
+    # Step the game from an input stream as fast as possible, nothing is drawn
+    game = Game(level, seed=seed, prefetch=not stop_at_door)
+    for keys in inputs:
+        game.update(keys)
+        if game.restart or game.finish or (stop_at_door and game.level != level):
+            break
+        if max_ticks is not None and game.ticks >= max_ticks:
+            break
+    return game
 
-def main_menu():
-    menu_img = pygame.transform.scale(BG, (800, 800))
-    WIN.blit(menu_img, (0, 0))
 
-    player = pygame.transform.scale(PLAYER['stand'][5], (90, 110))
-    WIN.blit(player, (60, 20))
-    player_label = SCORE_FONT.render("Left and right to move. Up to jump. Down to collect flowers.", True, BLACK)
-    WIN.blit(player_label, (180, 75))
+# Game is on
+# Screens of the game loop
+MENU = 'menu'
+PLAYING = 'playing'
+DEAD = 'dead'
+FINISHED = 'finished'
+
+
+class Session:
+    # One loop for the menu and every game, restarting replaces the game instead of calling the loop again
+    def __init__(self, record_path=None, replay=None, state=MENU):
+        self.record_path = record_path
+        # Games recorded so far, every game after the first gets its own numbered file
+        self.recorded = 0
+        self.replay = replay
+        self.game = None
+        self.inputs = None
+        self.recording = None
+        self.running = True
+        self.clock = pygame.time.Clock()
+        restart = ASSETS.get(RESTART)
+        self.restart_btn = Button(WIDTH // 2 - restart.get_width() // 2, HEIGHT // 2 + 100, restart)
+        # Textures are drawn on a back buffer that starts over every frame, redraw all of it
+        self.renderer = Renderer(DIRTY_RECTS and not isinstance(WIN, TextureWindow))
+
+        # Simulation runs in fixed ticks, drawing happens as often as the frame cap allows
+        self.tick_time = 1 / TICK_RATE
+        self.accumulator = 0
+        self.previous_time = time.perf_counter()
+
+        self.state = state
+        if state == MENU:
+            self.draw_menu()
+        else:
+            self.start_game()
+
+    def start_game(self):
+        # Let go of the old game and its world before building the next one
+        self.save_recording()
+        self.game = None
+        self.renderer.static_state = None
+        self.renderer.background = None
+        if self.replay is None:
+            self.game = Game()
+            self.inputs = None
+        else:
+            self.game = Game(self.replay.level, seed=self.replay.seed)
+            self.inputs = self.replay.key_states()
+            # Restarting after a replay plays a new game
+            self.replay = None
+        self.recording = Recording(self.game.level, self.game.seed) if self.record_path else None
+        self.accumulator = 0
+        self.previous_time = time.perf_counter()
+        self.state = PLAYING
+
+    def save_recording(self):
+        if self.recording is None:
+            return
+        self.recorded += 1
+        path = self.record_path
+        if self.recorded > 1:
+            root, extension = os.path.splitext(path)
+            path = f'{root}-{self.recorded}{extension}'
+        self.recording.save(path)
+        # Saved once, the session ending right after a restart shouldn't save it again
+        self.recording = None
+
+    def run(self):
+        while self.running:
+            self.frame()
+        self.save_recording()
+        PROFILER.close()
+        pygame.quit()
+
+    def frame(self):
+        if self.state == MENU:
+            # Nothing moves on the menu, no need to spin
+            self.clock.tick(TICK_RATE)
+            if isinstance(WIN, TextureWindow):
+                self.draw_menu()
+        else:
+            self.clock.tick(FPS)
+            self.update()
+            self.refresh_window(self.accumulator / self.tick_time)
 
-    flower = pygame.transform.scale(FLOWER[0], (FLOWER[0].get_width() // 2, FLOWER[0].get_height() // 2))
-    WIN.blit(flower, (90, 170))
-    flower_label = SCORE_FONT.render("Collect flowers.", True, BLACK)
-    WIN.blit(flower_label, (180, 170))
+        for event in pygame.event.get():
+            # Close window. With textures the hidden display window stays open, so SDL sends no QUIT
+            # when the visible one is closed
+            if event.type in (pygame.QUIT, pygame.WINDOWCLOSE):
+                self.running = False
+            if event.type == pygame.MOUSEBUTTONDOWN and self.state == MENU:
+                self.start_game()
+            # F3 shows frame times
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                PROFILER.visible = not PROFILER.visible
 
-    worm = pygame.transform.scale(WORM[0][0], (WORM[0][0].get_width() // 2, WORM[0][0].get_height() // 2))
-    WIN.blit(worm, (75, 205))
-    worm_label = SCORE_FONT.render("Worms and bugs are scary. They try to harm you.", True, BLACK)
-    WIN.blit(worm_label, (180, 245))
+    def update(self):
+        game = self.game
+        now = time.perf_counter()
+        self.accumulator += now - self.previous_time
+        self.previous_time = now
+
+        # Catch up on missed ticks without drawing them
+        PROFILER.start()
+        ticks = 0
+        while self.accumulator >= self.tick_time and ticks < MAX_TICKS_PER_FRAME:
+            if self.inputs is None:
+                keys = KeyState.from_pressed(pygame.key.get_pressed())
+            else:
+                keys = next(self.inputs, KeyState())
+            if self.recording is not None:
+                self.recording.record(keys)
+            game.update_sprites()
+            PROFILER.lap('sprites')
+            game.update_player(keys)
+            PROFILER.lap('player')
+            self.accumulator -= self.tick_time
+            ticks += 1
+
+        # Too far behind, drop the rest instead of trying to catch up forever
+        if ticks == MAX_TICKS_PER_FRAME:
+            self.accumulator %= self.tick_time
+
+        if game.finish_btn:
+            self.state = FINISHED
+        elif game.restart:
+            self.state = DEAD
+
+    def refresh_window(self, alpha):
+        game = self.game
+        renderer = self.renderer
+        world = game.world
+        player = game.player
+
+        # Alpha is how far we are between the last two simulation ticks
+        offset = game.camera.interpolate(alpha)
+        if renderer.dirty:
+            # Where the moving sprites go this frame
+            worms = renderer.blits(world.worm_group, alpha, offset)
+            flies = renderer.blits(world.fly_group, alpha, offset)
+            platforms = renderer.blits(world.platform_group, alpha, offset)
+            x, y = interpolate(player, alpha)
+            moving = [pygame.Rect(position, image.get_size()) for image, position in worms + flies + platforms]
+            moving.append(pygame.Rect(x - offset[0], y - offset[1], player.get_width(), player.get_height()))
+
+            # Put the background back there and where things were drawn last frame
+            renderer.restore(WIN, world, offset, moving)
+
+            # Draw moving sprites in the same order as a full redraw, flowers and doors go over enemies
+            renderer.draw_blits(WIN, worms)
+            renderer.draw_blits(WIN, flies)
+            renderer.draw_static(WIN, world.flower_group, offset)
+            renderer.draw_blits(WIN, platforms)
+            renderer.draw_static(WIN, world.door_group, offset)
+
+            # Draw player
+            renderer.mark(player.draw(WIN, alpha, offset))
+        else:
+            # Draw images, world and water to the screen
+            renderer.draw_background(WIN, world, offset)
+
+            # Draw sprites
+            renderer.draw_group(WIN, world.worm_group, alpha, offset)
+            renderer.draw_group(WIN, world.fly_group, alpha, offset)
+            renderer.draw_group(WIN, world.flower_group, None, offset)
+            renderer.draw_group(WIN, world.platform_group, alpha, offset)
+            renderer.draw_group(WIN, world.door_group, None, offset)
+
+            # Draw player
+            player.draw(WIN, alpha, offset)
+        PROFILER.lap('world')
 
-    fly = pygame.transform.scale(FLY[0][0], (FLY[0][0].get_width() // 2, FLY[0][0].get_height() // 2))
-    WIN.blit(fly, (75, 295))
-    fly_label = SCORE_FONT.render("Bees and flies are scary. They try to harm you.", True, BLACK)
-    WIN.blit(fly_label, (180, 320))
+        # Draw gridlines
+        # grid_lines(offset)
 
-    water = pygame.transform.scale(WATER[0], (WATER[0].get_width() // 2, WATER[0].get_height() // 2))
-    WIN.blit(water, (75, 365))
-    water_label = SCORE_FONT.render("Player can swim. Don't go too deep though.", True, BLACK)
-    WIN.blit(water_label, (180, 395))
+        # Level text
+        level_label = TEXT_CACHE.render(SCORE_FONT, f'LEVEL {game.level}', True, BLACK)
+        renderer.mark(WIN.blit(level_label, (WIDTH//2 + 83, 52)))
 
-    health = pygame.transform.scale(HEALTH, (HEALTH.get_width() // 2, HEALTH.get_height() // 2))
-    WIN.blit(health, (55, 482))
-    health_label = SCORE_FONT.render("This is your health bar. If all red, game over.", True, BLACK)
-    WIN.blit(health_label, (180, 470))
+        # Score text
+        renderer.mark(WIN.blit(world.score_flower.image, world.score_flower.rect))
+        score_label = TEXT_CACHE.render(SCORE_FONT, f'X {game.score}', True, BLACK)
+        renderer.mark(WIN.blit(score_label, (WIDTH - 110, 52)))
 
-    door = pygame.transform.scale(DOOR, (DOOR.get_width(), DOOR.get_height()))
-    WIN.blit(door, (75, 530))
-    door_label = SCORE_FONT.render("Enter next level through this door.", True, BLACK)
-    WIN.blit(door_label, (180, 545))
+        # Health bar
+        health_label = TEXT_CACHE.render(SCORE_FONT, 'HEALTH', True, BLACK)
+        renderer.mark(WIN.blit(health_label, (63, 52)))
+        renderer.mark(player.health_bar(WIN, 154, 58))
 
-    begin_label = SCORE_FONT.render("Click mouse button to begin...", True, BLACK)
-    WIN.blit(begin_label, (260, 645))
+        # Finish game
+        restart = False
+        if self.state == FINISHED:
+            finish_label = TEXT_CACHE.render(FINISH_FONT, 'Congratulations! You finished the game.', True, ORANGE)
+            renderer.mark(WIN.blit(finish_label, (WIDTH // 2 - finish_label.get_width() // 2, HEIGHT // 2)))
+            renderer.mark(self.restart_btn.rect)
+            restart = self.restart_btn.draw(WIN)
 
-    while True:
-        pygame.display.update()
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == pygame.MOUSEBUTTONDOWN:
-                platform_game()
+        # Restart game
+        if self.state == DEAD:
+            game_over_label = TEXT_CACHE.render(RESTART_FONT, 'Game Over', True, ORANGE)
+            renderer.mark(WIN.blit(game_over_label, (WIDTH // 2 - game_over_label.get_width() // 2, HEIGHT // 2)))
+            renderer.mark(self.restart_btn.rect)
+            restart = self.restart_btn.draw(WIN)
+
+        # Frame time overlay
+        overlay_rect = PROFILER.draw(WIN)
+        if overlay_rect is not None:
+            renderer.mark(overlay_rect)
+        PROFILER.lap('hud')
+
+        # Update window
+        renderer.update()
+        PROFILER.lap('flip')
+        PROFILER.end_frame()
+
+        if restart:
+            self.start_game()
+
+    def draw_menu(self):
+        menu_img = ASSETS.get(BG, (800, 800))
+        WIN.blit(menu_img, (0, 0))
+
+        player = ASSETS.get(PLAYER['stand'][5], (90, 110))
+        WIN.blit(player, (60, 20))
+        player_label = TEXT_CACHE.render(SCORE_FONT, "Left and right to move. Up to jump. Down to collect flowers.", True, BLACK)
+        WIN.blit(player_label, (180, 75))
+
+        flower = ASSETS.get(FLOWER[0], 0.5)
+        WIN.blit(flower, (90, 170))
+        flower_label = TEXT_CACHE.render(SCORE_FONT, "Collect flowers.", True, BLACK)
+        WIN.blit(flower_label, (180, 170))
+
+        worm = ASSETS.get(WORM[0][0], 0.5)
+        WIN.blit(worm, (75, 205))
+        worm_label = TEXT_CACHE.render(SCORE_FONT, "Worms and bugs are scary. They try to harm you.", True, BLACK)
+        WIN.blit(worm_label, (180, 245))
+
+        fly = ASSETS.get(FLY[0][0], 0.5)
+        WIN.blit(fly, (75, 295))
+        fly_label = TEXT_CACHE.render(SCORE_FONT, "Bees and flies are scary. They try to harm you.", True, BLACK)
+        WIN.blit(fly_label, (180, 320))
+
+        water = ASSETS.get(WATER[0], 0.5)
+        WIN.blit(water, (75, 365))
+        water_label = TEXT_CACHE.render(SCORE_FONT, "Player can swim. Don't go too deep though.", True, BLACK)
+        WIN.blit(water_label, (180, 395))
+
+        health = ASSETS.get(HEALTH, 0.5)
+        WIN.blit(health, (55, 482))
+        health_label = TEXT_CACHE.render(SCORE_FONT, "This is your health bar. If all red, game over.", True, BLACK)
+        WIN.blit(health_label, (180, 470))
+
+        WIN.blit(ASSETS.get(DOOR), (75, 530))
+        door_label = TEXT_CACHE.render(SCORE_FONT, "Enter next level through this door.", True, BLACK)
+        WIN.blit(door_label, (180, 545))
+
+        begin_label = TEXT_CACHE.render(SCORE_FONT, "Click mouse button to begin...", True, BLACK)
+        WIN.blit(begin_label, (260, 645))
+
+        present()
+
+
+def platform_game(record_path=None, replay=None):
+    # Play from the keyboard, or watch a recording play itself
+    Session(record_path, replay, PLAYING).run()
+
+
+def main_menu(record_path=None):
+    Session(record_path).run()
+
+
+def headless_runs(level, runs, max_ticks, seed):
+    # Random playthroughs of one level, for checking levels without a display
+    rng = random.Random(seed)
+    results = collections.Counter()
+    ticks = 0
+    start = time.perf_counter()
+    for _ in range(runs):
+        game = run_headless(random_inputs(rng), level, max_ticks)
+        ticks += game.ticks
+        if game.player_dead:
+            results['died'] += 1
+        elif game.finish or game.level != level:
+            results['reached door'] += 1
+        else:
+            results['timed out'] += 1
+    elapsed = time.perf_counter() - start
+    print(f'Level {level}: {runs} runs, ' + ', '.join(f'{count} {result}' for result, count in sorted(results.items())))
+    print(f'{ticks} ticks in {elapsed:.2f} s, {ticks / elapsed:.0f} ticks/s')
+
+
+def replay_headless(path):
+    # Fast forward through a recording without drawing anything
+    recording = Recording.load(path)
+    start = time.perf_counter()
+    game = run_headless(recording.key_states(), recording.level, seed=recording.seed, stop_at_door=False)
+    elapsed = time.perf_counter() - start
+    state = 'died' if game.player_dead else 'finished' if game.finish else 'playing'
+    print(f'{path}: {game.ticks} ticks, level {game.level}, score {game.score}, health {game.player.health}, {state}')
+    print(f'Replayed in {elapsed:.2f} s, {game.ticks / elapsed:.0f} ticks/s')
 
 
 if __name__ == '__main__':
-    main_menu()
+    parser = argparse.ArgumentParser(description='Platform game')
+    parser.add_argument('--headless', action='store_true', help='simulate random playthroughs without a window or sound')
+    parser.add_argument('--level', type=int, default=1, help='level to simulate')
+    parser.add_argument('--runs', type=int, default=100, help='number of simulated playthroughs')
+    parser.add_argument('--ticks', type=int, default=TICK_RATE * 60, help='longest playthrough in ticks')
+    parser.add_argument('--seed', type=int, default=None, help='seed for the random inputs')
+    parser.add_argument('--record', metavar='FILE', help='save the inputs of the game to FILE')
+    parser.add_argument('--replay', metavar='FILE', help='play back a recording, with --headless as fast as possible')
+    parser.add_argument('--profile', metavar='FILE', help='write frame times to a .csv or .jsonl file, F3 shows them in game')
+    parser.add_argument('--convert', metavar='PICKLE', nargs='+', help='convert pickled levels to .lvl files next to them')
+    parser.add_argument('--atlas', action='store_true', help='pack the sprite images into the atlas again and exit')
+    parser.add_argument('--textures', action='store_true', help='draw with textures through an SDL renderer')
+    parser.add_argument('--uncapped', action='store_true', help=f'draw as many frames as the display allows, not {FPS}')
+    args = parser.parse_args()
+    if args.uncapped:
+        FPS = 0
+    if args.profile:
+        PROFILER.export_to(args.profile)
+    # Converting levels and packing images need no window
+    if not args.convert and not args.atlas:
+        init(textures=args.textures or None)
+    if args.atlas:
+        sheets, index = ATLAS.build()
+        print(f'{len(index["frames"])} images -> {len(sheets)} sheets at {ATLAS.path}')
+    elif args.convert:
+        for path in args.convert:
+            Level.from_pickle(path).save(path + '.lvl')
+            print(f'{path} -> {path}.lvl')
+    elif args.replay and args.headless:
+        replay_headless(args.replay)
+    elif args.headless:
+        headless_runs(args.level, args.runs, args.ticks, args.seed)
+    elif args.replay:
+        platform_game(replay=Recording.load(args.replay))
+    else:
+        main_menu(args.record)
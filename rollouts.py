@@ -0,0 +1,206 @@
+import argparse
+import array
+import concurrent.futures
+import json
+import os
+import random
+import time
+
+# Rollouts never draw or play sound, keep pygame away from the display and its greeting out of the output
+os.environ.setdefault('PLATFORM_HEADLESS', '1')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import pygame
+
+import main
+
+# Games stepped together in one loop by each worker
+BATCH_SIZE = 32
+
+
+def rightward_inputs(rng, hold=15):
+    # Scripted player: always heads for the door on the right, jumping now and then
+    while True:
+        keys = main.KeyState(rng.random() < 0.1, rng.random() < 0.9, rng.random() < 0.4, False)
+        for _ in range(hold):
+            yield keys
+
+
+# Input policy name -> function of an rng giving endless KeyStates
+POLICIES = {
+    'random': main.random_inputs,
+    'rightward': rightward_inputs,
+}
+
+
+class Heatmaps:
+    # Per tile counts of one level over many rollouts, plus totals for the summary
+    KINDS = ('visits', 'damage', 'deaths')
+
+    def __init__(self, level, width, height):
+        self.level = level
+        self.width = width
+        self.height = height
+        self.maps = {kind: array.array('I', bytes(4 * width * height)) for kind in self.KINDS}
+        self.runs = 0
+        self.ticks = 0
+        self.doors = 0
+        self.door_ticks = 0
+        self.damage = 0
+
+    def add(self, kind, rect, amount=1):
+        column = min(max(rect.centerx // main.TILE_SIZE, 0), self.width - 1)
+        row = min(max(rect.centery // main.TILE_SIZE, 0), self.height - 1)
+        self.maps[kind][row * self.width + column] += amount
+
+    def merge(self, other):
+        for kind in self.KINDS:
+            counts = self.maps[kind]
+            for index, count in enumerate(other.maps[kind]):
+                if count:
+                    counts[index] += count
+        self.runs += other.runs
+        self.ticks += other.ticks
+        self.doors += other.doors
+        self.door_ticks += other.door_ticks
+        self.damage += other.damage
+
+    def hottest(self, kind, count=5):
+        counts = self.maps[kind]
+        cells = sorted((index for index, value in enumerate(counts) if value), key=counts.__getitem__, reverse=True)
+        return [(index % self.width, index // self.width, counts[index]) for index in cells[:count]]
+
+    def summary(self):
+        return {
+            'level': self.level,
+            'runs': self.runs,
+            'ticks': self.ticks,
+            'reached_door': self.doors,
+            'mean_ticks_to_door': self.door_ticks / self.doors if self.doors else None,
+            'mean_damage': self.damage / self.runs if self.runs else 0.0,
+            'deaths': sum(self.maps['deaths']),
+            'worst_tiles': {kind: self.hottest(kind) for kind in ('damage', 'deaths')},
+        }
+
+    def save(self, folder, tiles, scale=8):
+        # One image per kind: solid tiles grey, counts from dark to bright red
+        paths = []
+        for kind in self.KINDS:
+            counts = self.maps[kind]
+            top = max(counts) or 1
+            image = pygame.Surface((self.width * scale, self.height * scale))
+            for index, count in enumerate(counts):
+                if tiles[index] in main.World.SOLID_TILES:
+                    color = (90, 90, 90)
+                elif count:
+                    color = (80 + 175 * count // top, 0, 0)
+                else:
+                    continue
+                image.fill(color, ((index % self.width) * scale, (index // self.width) * scale, scale, scale))
+            paths.append(os.path.join(folder, f'level{self.level}-{kind}.png'))
+            pygame.image.save(image, paths[-1])
+        return paths
+
+
+class RolloutBatch:
+    # Many independent games of one level, stepped together one tick at a time
+    def __init__(self, level, runs, policy='random', max_ticks=main.TICK_RATE * 60, health=100, seed=None,
+                 batched=True):
+        rng = random.Random(seed)
+        data = main.LEVELS.level(level)
+        self.level = level
+        self.max_ticks = max_ticks
+        self.heatmaps = Heatmaps(level, data.width, data.height)
+        # Touching the door finishes the game instead of building the next level
+        self.games = [main.Game(level, max_levels=level, health=health, seed=rng.getrandbits(32), prefetch=False)
+                      for _ in range(runs)]
+        self.inputs = [POLICIES[policy](random.Random(rng.getrandbits(64))) for _ in range(runs)]
+        self.active = list(range(runs))
+        # Enemies and platforms of every game in one store, moved with one NumPy update a tick
+        self.store = main.EntityStore() if main.numpy is not None and batched else None
+        if self.store is not None:
+            for game in self.games:
+                for group in (game.world.worm_group, game.world.fly_group, game.world.platform_group):
+                    group.use_store(self.store)
+
+    def step(self):
+        heatmaps = self.heatmaps
+        still_active = []
+        if self.store is not None:
+            self.store.update()
+        for index in self.active:
+            game = self.games[index]
+            player = game.player
+            health = player.health
+            if self.store is None:
+                game.update_sprites()
+            else:
+                game.world.clock.tick()
+            game.update_player(next(self.inputs[index]))
+            heatmaps.add('visits', player.rect)
+            if player.health < health:
+                heatmaps.add('damage', player.rect, health - player.health)
+                heatmaps.damage += health - player.health
+            if game.player_dead:
+                heatmaps.add('deaths', player.rect)
+            elif game.finish:
+                heatmaps.doors += 1
+                heatmaps.door_ticks += game.ticks
+            elif game.ticks < self.max_ticks:
+                still_active.append(index)
+                continue
+            heatmaps.runs += 1
+            heatmaps.ticks += game.ticks
+        self.active = still_active
+
+    def run(self):
+        while self.active:
+            self.step()
+        return self.heatmaps
+
+
+def run_batch(level, runs, policy, max_ticks, health, seed):
+    # Runs in the worker processes
+    return RolloutBatch(level, runs, policy, max_ticks, health, seed).run()
+
+
+def rollouts(level, runs, policy='random', max_ticks=main.TICK_RATE * 60, health=100, seed=None, workers=None):
+    # Split the runs into batches, one worker process per core
+    rng = random.Random(seed)
+    sizes = [min(BATCH_SIZE, runs - start) for start in range(0, runs, BATCH_SIZE)]
+    jobs = [(level, size, policy, max_ticks, health, rng.getrandbits(64)) for size in sizes]
+    if workers == 1:
+        main.init()
+        batches = [run_batch(*job) for job in jobs]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=main.init) as executor:
+            batches = list(executor.map(run_batch, *zip(*jobs)))
+    heatmaps = batches[0]
+    for batch in batches[1:]:
+        heatmaps.merge(batch)
+    return heatmaps
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate many players on a level and map where they get hurt and die')
+    parser.add_argument('levels', type=int, nargs='*', default=list(range(1, 11)), help='level numbers, all by default')
+    parser.add_argument('--runs', type=int, default=256, help='rollouts per level')
+    parser.add_argument('--policy', choices=sorted(POLICIES), default='random', help='how the simulated players press keys')
+    parser.add_argument('--ticks', type=int, default=main.TICK_RATE * 60, help='longest rollout in ticks')
+    parser.add_argument('--health', type=int, default=100, help='starting health, 1 dies on the first hit like the game')
+    parser.add_argument('--seed', type=int, default=None, help='seed for the inputs and levels')
+    parser.add_argument('--workers', type=int, default=None, help='processes to use, one per core by default')
+    parser.add_argument('--out', metavar='DIR', help='save visits, damage and deaths heatmaps of each level as images')
+    args = parser.parse_args()
+    if args.out:
+        os.makedirs(args.out, exist_ok=True)
+    ticks = 0
+    start = time.perf_counter()
+    for level in args.levels:
+        heatmaps = rollouts(level, args.runs, args.policy, args.ticks, args.health, args.seed, args.workers)
+        ticks += heatmaps.ticks
+        print(json.dumps(heatmaps.summary()))
+        if args.out:
+            heatmaps.save(args.out, main.LEVELS.level(level).tiles)
+    elapsed = time.perf_counter() - start
+    print(f'{ticks} ticks in {elapsed:.2f} s, {ticks / elapsed:.0f} ticks/s')